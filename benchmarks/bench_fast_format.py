@@ -0,0 +1,407 @@
+##############################################################################
+#
+# bench_fast_format.py
+#
+# Benchmarks for the formatting functions of fast_format.py. Neither
+# Mnemosyne nor Qt is needed.
+#
+# Synthetic card corpora are generated from a fixed seed, so that runs are
+# comparable, and each benchmark formats every card of a corpus in turn,
+# several times over. For each, the throughput (cards and characters per
+# second), the latency percentiles per card and the peak memory allocated
+# are reported.
+#
+# Then long pathological fields, full of delimiters that are never closed,
+# are formatted at doubling lengths to show that the time taken grows
+# linearly with the length (--growth-chars 0 to skip).
+#
+#   python benchmarks/bench_fast_format.py
+#   python benchmarks/bench_fast_format.py --only markup --cards 500
+#   python benchmarks/bench_fast_format.py --save before.json
+#   python benchmarks/bench_fast_format.py --compare before.json
+#
+##############################################################################
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import fast_format
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+##############################################################################
+# Corpora
+
+words = ("the of and to in is was for that with as by on at from this word "
+         "verb noun adjective meaning usage example plural past tense "
+         "dictionary entry definition sense colloquial formal archaic").split()
+
+cjk = u"日本語漢字学校先生電車" \
+      u"駅時間今日明日水火木金"
+
+def plain_card(rnd):
+    return ' '.join(rnd.choice(words) for _ in range(rnd.randint(3, 40)))
+
+markups = [('[', ']'), ('{', '}'), ('_', '_'), ('*', '*'), ('`', '`'),
+           ('``', '``'), ('#', '#'), ('##', '##')]
+
+def markup_card(rnd):
+    parts = []
+    for _ in range(rnd.randint(3, 40)):
+        w = rnd.choice(words)
+        r = rnd.random()
+        if r < 0.3:
+            (o, c) = rnd.choice(markups)
+            w = o + w + c
+        elif r < 0.35:
+            w = '\\' + rnd.choice('[]{}_*`#') + w
+        parts.append(w)
+    return ' '.join(parts)
+
+def media_card(rnd):
+    parts = []
+    for _ in range(rnd.randint(3, 30)):
+        r = rnd.random()
+        if r < 0.1:
+            parts.append('<img src="images/%s_%d.png">'
+                         % (rnd.choice(words), rnd.randint(0, 999)))
+        elif r < 0.15:
+            parts.append('<audio src="sounds/%s_#%d.mp3">'
+                         % (rnd.choice(words), rnd.randint(0, 999)))
+        elif r < 0.35:
+            (o, c) = rnd.choice(markups)
+            parts.append(o + rnd.choice(words) + c)
+        else:
+            parts.append(rnd.choice(words))
+    return ' '.join(parts)
+
+def unmatched_card(rnd):
+    # Pasted code and urls: many stray delimiters with nothing to close them.
+    parts = []
+    for _ in range(rnd.randint(10, 60)):
+        w = rnd.choice(words)
+        if rnd.random() < 0.4:
+            w = w + rnd.choice('_*#`[{')
+        parts.append(w)
+    return ' '.join(parts)
+
+def cjk_card(rnd):
+    # Non-latin characters wrapped in size tags by Mnemosyne.
+    parts = []
+    for _ in range(rnd.randint(5, 60)):
+        if rnd.random() < 0.6:
+            parts.append('<span style="font-size:24pt">%s</span>'
+                         % rnd.choice(cjk))
+        else:
+            (o, c) = rnd.choice(markups)
+            parts.append(o + rnd.choice(cjk) + rnd.choice(words) + c)
+    return ''.join(parts)
+
+def long_card(rnd):
+    return '\n'.join(markup_card(rnd) for _ in range(200))
+
+corpora = {
+    'plain'     : plain_card,
+    'markup'    : markup_card,
+    'media'     : media_card,
+    'unmatched' : unmatched_card,
+    'cjk'       : cjk_card,
+    'long'      : long_card,
+}
+
+def make_corpus(name, cards, seed):
+    rnd = random.Random('%s-%d' % (name, seed))
+    n = cards if name != 'long' else max(1, cards // 50)
+    return [corpora[name](rnd) for _ in range(n)]
+
+##############################################################################
+# Benchmarks
+#
+# Each takes the compiled default rules and returns a function of one text.
+
+def bench_format(formats):
+    return lambda text: fast_format.format(text, formats)
+
+def bench_format_skip_tags(formats):
+    return lambda text: fast_format.format(text, formats, skip_tags=True)
+
+def bench_format_html(formats):
+    return lambda text: fast_format.format_html(text, formats)
+
+def bench_format_legacy(formats):
+    # The rules run one after the other through regex.sub, as before fusion.
+    legacy = list(formats)
+    return lambda text: fast_format.format(text, legacy)
+
+def bench_strip_thread(formats):
+    def run(text):
+        (text, tags) = fast_format.strip_tags(text)
+        return fast_format.thread_tags(text, tags)
+    return run
+
+def bench_filter(formats):
+    # The work done by FastFormat.run() for an uncached field.
+    return lambda text: fast_format.format(
+        text, formats, spans=fast_format.media_spans(text))
+
+def bench_compile(formats):
+    source = [(regex.pattern, sub) for (regex, sub) in formats]
+    return lambda text: fast_format.compile_formats(source)
+
+benchmarks = [
+    ('format',            bench_format),
+    ('format_skip_tags',  bench_format_skip_tags),
+    ('format_html',       bench_format_html),
+    ('format_legacy',     bench_format_legacy),
+    ('strip_thread_tags', bench_strip_thread),
+    ('filter',            bench_filter),
+    ('compile_formats',   bench_compile),
+]
+
+def percentile(sorted_times, p):
+    i = min(len(sorted_times) - 1, int(round(p / 100.0 * len(sorted_times))))
+    return sorted_times[i]
+
+def run_one(fn, corpus, repeat):
+    for text in corpus[:10]:
+        fn(text)
+
+    times = []
+    chars = 0
+    start = clock()
+    for _ in range(repeat):
+        for text in corpus:
+            t0 = clock()
+            fn(text)
+            times.append(clock() - t0)
+            chars += len(text)
+    total = clock() - start
+
+    tracemalloc.start()
+    for text in corpus:
+        fn(text)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times.sort()
+    return {
+        'cards_per_s' : len(times) / total,
+        'chars_per_s' : chars / total,
+        'p50_us'      : percentile(times, 50) * 1e6,
+        'p90_us'      : percentile(times, 90) * 1e6,
+        'p99_us'      : percentile(times, 99) * 1e6,
+        'max_us'      : times[-1] * 1e6,
+        'peak_kb'     : peak / 1024.0,
+    }
+
+def run(args):
+    formats = fast_format.compile_formats(fast_format.default_formats)
+    results = {}
+    for (bname, make) in benchmarks:
+        if args.only and not any(o in bname for o in args.only):
+            continue
+        fn = make(formats)
+        for cname in sorted(corpora):
+            if args.corpus and cname not in args.corpus:
+                continue
+            if bname == 'compile_formats' and cname != 'plain':
+                continue
+            corpus = make_corpus(cname, args.cards, args.seed)
+            results['%s/%s' % (bname, cname)] = run_one(fn, corpus,
+                                                        args.repeat)
+    return results
+
+##############################################################################
+# Pathological inputs
+#
+# Each field repeats a unit up to the given length. A closing delimiter at
+# the start keeps the rules from being skipped for lack of one.
+
+pathological = {
+    'openers'   : (']}', 'word[ f(x{ '),      # never closed
+    'escaped'   : ('_a', 'b\\_ c\\* '),      # every closing one escaped
+    'urls'      : ('', 'http://a_b/c*d#e[f{g `h?i=1 '),
+    'tags'      : ('>', 'a < b *c* <img '),   # '<' that is never closed
+    'runs'      : ('', '_*#`'),
+}
+
+def pathological_field(name, length):
+    (head, unit) = pathological[name]
+    return (head + unit * (length // len(unit) + 1))[:length]
+
+def bench_stream(formats):
+    def run(text):
+        chunks = [text[i:i + 4096] for i in range(0, len(text), 4096)]
+        for piece in fast_format.format_stream(chunks, formats):
+            pass
+    return run
+
+def bench_incremental(formats):
+    # A first render, which goes through the streams one segment at a time.
+    return lambda text: fast_format.IncrementalRender(formats).render(text)
+
+growth_benchmarks = [
+    ('format',            bench_format),
+    ('format_skip_tags',  bench_format_skip_tags),
+    ('format_html',       bench_format_html),
+    ('filter',            bench_filter),
+    ('format_stream',     bench_stream),
+    ('incremental',       bench_incremental),
+]
+
+def growth(lengths, times):
+    # The slope of log time against log length: about 1 when the time taken
+    # is linear in the length, 2 when quadratic.
+    xs = [math.log(n) for n in lengths]
+    ys = [math.log(max(t, 1e-9)) for t in times]
+    mx = sum(xs) / len(xs)
+    my = sum(ys) / len(ys)
+    return (sum((x - mx) * (y - my) for (x, y) in zip(xs, ys))
+            / sum((x - mx) ** 2 for x in xs))
+
+def run_growth(args):
+    # The best time taken at each of four doubling lengths, and its growth.
+    formats = fast_format.compile_formats(fast_format.default_formats)
+    lengths = [args.growth_chars << k for k in range(4)]
+    results = {}
+    for (bname, make) in growth_benchmarks:
+        if args.only and not any(o in bname for o in args.only):
+            continue
+        fn = make(formats)
+        for name in sorted(pathological):
+            times = []
+            for length in lengths:
+                text = pathological_field(name, length)
+                best = None
+                for _ in range(max(args.repeat, 1)):
+                    t0 = clock()
+                    fn(text)
+                    t = clock() - t0
+                    best = t if best is None else min(best, t)
+                times.append(best)
+            results['%s/%s' % (bname, name)] = {
+                'lengths' : lengths,
+                'times'   : times,
+                'growth'  : growth(lengths, times),
+            }
+    return results
+
+##############################################################################
+# Reporting
+
+columns = [('cards_per_s', 'cards/s', '%10.0f'),
+           ('chars_per_s', 'Mchar/s', '%8.2f'),
+           ('p50_us', 'p50 us', '%9.1f'),
+           ('p90_us', 'p90 us', '%9.1f'),
+           ('p99_us', 'p99 us', '%9.1f'),
+           ('peak_kb', 'peak KB', '%9.1f')]
+
+def report(results, baseline=None):
+    width = max([len(k) for k in results] + [10])
+    header = '%-*s' % (width, 'benchmark')
+    for (key, title, fmt) in columns:
+        header += ' %*s' % (len(fmt % 0), title)
+    if baseline is not None:
+        header += '  %8s' % 'speedup'
+    print(header)
+    print('-' * len(header))
+
+    for name in sorted(results):
+        r = results[name]
+        line = '%-*s' % (width, name)
+        for (key, title, fmt) in columns:
+            value = r[key] / 1e6 if key == 'chars_per_s' else r[key]
+            line += ' ' + fmt % value
+        if baseline is not None:
+            if name in baseline:
+                line += '  %7.2fx' % (baseline[name]['p50_us']
+                                      / max(r['p50_us'], 1e-9))
+            else:
+                line += '  %8s' % '-'
+        print(line)
+
+def report_growth(results, baseline=None):
+    lengths = next(iter(results.values()))['lengths']
+    width = max([len(k) for k in results] + [10])
+    header = '%-*s' % (width, 'pathological')
+    for length in lengths:
+        header += ' %9s' % ('%dk ms' % (length // 1000))
+    header += '  %6s' % 'growth'
+    if baseline is not None:
+        header += '  %6s' % 'before'
+    print(header)
+    print('-' * len(header))
+
+    for name in sorted(results):
+        r = results[name]
+        line = '%-*s' % (width, name)
+        for t in r['times']:
+            line += ' %9.2f' % (t * 1e3)
+        line += '  %6.2f' % r['growth']
+        if baseline is not None:
+            if name in baseline:
+                line += '  %6.2f' % baseline[name]['growth']
+            else:
+                line += '  %6s' % '-'
+        print(line)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=
+            'Benchmark the fast_format formatting functions.')
+    parser.add_argument('--cards', type=int, default=2000,
+                        help='cards per corpus (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='passes over each corpus (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='corpus seed (default: %(default)s)')
+    parser.add_argument('--only', action='append', metavar='NAME',
+                        help='only run benchmarks whose name contains NAME')
+    parser.add_argument('--corpus', action='append', metavar='NAME',
+                        choices=sorted(corpora),
+                        help='only use the named corpus')
+    parser.add_argument('--growth-chars', type=int, default=20000,
+                        help='shortest pathological field, doubled three '
+                             'times (default: %(default)s; 0 to skip)')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save the results as json')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare median latency against saved results')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    growth = run_growth(args) if args.growth_chars > 0 else {}
+
+    baseline = None
+    growth_baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        baseline = saved['results']
+        growth_baseline = saved.get('growth')
+    report(results, baseline)
+    if growth:
+        print('')
+        report_growth(growth, growth_baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({ 'version' : fast_format.version,
+                        'python'  : sys.version.split()[0],
+                        'cards'   : args.cards,
+                        'seed'    : args.seed,
+                        'results' : results,
+                        'growth'  : growth }, f, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
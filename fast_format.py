@@ -82,35 +82,131 @@
 # Changes in 2.0.5
 #   * Ported to Mnemosyne 2.5 (which uses Python 3 and PyQt5)
 #
+# Changes in 2.1.0
+#   * Runs of delimiter and escape rules are fused into a single scan of the
+#     text (the result is unchanged).
+#   * Rendered fields are cached (see fast_format_cache_entries and
+#     fast_format_cache_chars in the configuration); the hits and misses of
+#     the cache are shown in the configuration dialog.
+#   * Optionally keep rendered fields between sessions in
+#     fast_format_cache.db in the configuration directory (set
+#     fast_format_disk_cache to True).
+#   * format_many() formats a sequence of texts, optionally spread over
+#     several processes.
+#   * Rules are skipped when the text lacks characters they need to match.
+#   * Fields that are left unchanged are passed through untouched and
+#     remembered.
+#   * format_stream() formats very large texts piece by piece.
+#   * The number of matches and the time taken by each rule can be recorded
+#     (set fast_format_profile to True) and are shown in the configuration
+#     dialog.
+#   * Rules that may backtrack catastrophically are marked in the
+#     configuration dialog, and formatting a field can be made to stop once
+#     it has taken longer than fast_format_time_budget seconds.
+#   * The sample in the configuration dialog is rendered in the background
+#     once typing pauses, recompiling only the rules that changed.
+#   * The filters of all render chains share one compiled set of rules.
+#   * Images and sounds are skipped in place rather than swapped for
+#     placeholders, so fields containing U+FFFC are formatted correctly.
+#   * format_html() formats html fields without touching their tags;
+#     shortcuts may enclose whole inline elements like <b>...</b> or
+#     <span>...</span> (set fast_format_html to True).
+#   * With skip_tags, each rule runs once over the whole field rather than
+#     once between every two tags.
+#   * Qt is only imported once the configuration dialog is opened, and the
+#     formatting functions can be imported without Mnemosyne or Qt.
+#   * tools/format_deck.py formats exported decks from the command line.
+#   * After an edit to a long field, only the part that the edit can affect
+#     is formatted again, when every rule is fused into a scan.
+#   * Rules that do not affect each other are fused even when they are not
+#     next to each other. Rules that may never match are reported, as is
+#     the number of passes the rules run in once fused.
+#   * Escape rules written as \\(X) or \\([XYZ]) -> \1 are fused too, and
+#     escape rules that are not fused with delimiters are all removed in
+#     one substitution.
+#   * Optionally format the fields of the active cards in worker processes
+#     before the first export to Mnemogogo (set fast_format_prerender to
+#     True).
+#   * Shortcuts may be given as Delimiters (opening and closing
+#     delimiters, a template and an escape character) rather than regular
+#     expressions, optionally pairing nested delimiters or matching
+#     shortcuts that directly follow each other; default_delimiters gives
+#     the same results as default_formats.
+#   * Formatting takes time linear in the length of the field, however
+#     many delimiters are left unclosed: a pair of delimiters is always
+#     scanned, tags are only looked for up to the last '>', and
+#     format_stream() no longer goes over held-back text with every chunk.
+#   * Optionally format the next cards to be reviewed in the background
+#     (set fast_format_prefetch to the number of cards).
+#   * render_window() formats the fields of the rows in view of a card
+#     browser, and some either side, in one call, skipping fields formatted
+#     before. It is meant for the card browser, which does not call it yet.
+#
 ##############################################################################
 
+import sys
+
+# Qt is not imported here: only the configuration widget needs it, and it
+# is defined when the settings dialog is first opened. The formatting
+# functions can be used without Mnemosyne or Qt (e.g., by exporters).
+
 try:
   from mnemosyne.core import *
   mnemosyne_version = 1
 
 except ImportError:
     try:
-      mnemosyne_version = 2
-      from PyQt4 import QtCore, QtGui
       from mnemosyne.libmnemosyne.hook import Hook
       from mnemosyne.libmnemosyne.filter import Filter
       from mnemosyne.libmnemosyne.plugin import Plugin
       from mnemosyne.libmnemosyne.ui_components.configuration_widget import \
            ConfigurationWidget
 
-    except ImportError:
-      mnemosyne_version = 2.5
-      from PyQt5 import QtCore, QtGui, QtWidgets
-      from mnemosyne.libmnemosyne.hook import Hook
-      from mnemosyne.libmnemosyne.filter import Filter
-      from mnemosyne.libmnemosyne.plugin import Plugin
-      from mnemosyne.libmnemosyne.ui_components.configuration_widget import \
-           ConfigurationWidget
+      # Mnemosyne 2.5 moved to Python 3 and PyQt5.
+      if sys.version_info[0] < 3:
+          mnemosyne_version = 2
+      else:
+          mnemosyne_version = 2.5
 
+    except ImportError:
+      # Outside Mnemosyne (e.g., benchmarks): only the formatting functions.
+      mnemosyne_version = None
+
+import atexit
+import bisect
+import collections
+import hashlib
+import itertools
+import os
 import re
+import sqlite3
+import threading
+import time
+
+# multiprocessing and concurrent.futures are slow to import and only used
+# to stop risky rules and by format_many(), so they are imported on first
+# use by _load_multiprocessing().
+multiprocessing = None
+futures = None
+_multiprocessing_loaded = False
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
 
 name = "Fast Format"
-version = "2.0.5"
+version = "2.1.0"
 description = "ASCII shortcuts for common HTML tags. (v" + version + ")"
 help_text = "Use python \
   <a href=\"http://docs.python.org/howto/regex.html\">regular expressions</a>:\
@@ -144,46 +240,2345 @@ default_formats = [
     (r'\\#', r'#'),
     ]
 
+class Delimiters(object):
+    # A shortcut given by its delimiters rather than by a regular
+    # expression, for use in a list of rules alongside (regex, replacement)
+    # pairs. The text between opening and closing replaces {} in template
+    # (the delimiters too, if keep). Neither delimiter counts right after
+    # the escape character, and the text between them is never empty nor
+    # ends with it. Each opening delimiter goes with the first closing one
+    # after it, exactly as for
+    #   ([^\\]|^)OPEN(.*?[^\\])CLOSE     -> \1 pre \2 post
+    # where the character before a match is taken with it, so that another
+    # match cannot begin right where one ends (as in *a**b*). If adjacent,
+    # it can, and a match at the very start is tried first. If nested, the
+    # delimiters pair up like brackets and every pair is replaced, the
+    # inner ones as well. Either way, the text is matched in a single scan
+    # that is linear in its length.
+
+    def __init__(self, opening, closing, template, escape='\\',
+                 nested=False, keep=False, adjacent=False):
+        (pre, sep, post) = template.partition('{}')
+        if not opening or not closing or len(escape) != 1:
+            raise ValueError('delimiters must not be empty, and the escape '
+                             'must be a single character')
+        if escape in opening + closing or escape in template:
+            raise ValueError('the escape character %r must not appear in '
+                             'the delimiters or template' % escape)
+        if not sep or not pre or not post:
+            raise ValueError('the template must have text around {}')
+        if nested and opening[0] == closing[0]:
+            raise ValueError('nested delimiters must start differently')
+        self.opening = opening
+        self.closing = closing
+        self.template = template
+        self.escape = escape
+        self.nested = nested
+        self.keep = keep
+        self.adjacent = adjacent
+        self.pre = pre
+        self.post = post
+
+    def __repr__(self):
+        return ('Delimiters(%r, %r, %r, escape=%r, nested=%r, keep=%r, '
+                'adjacent=%r)' % (self.opening, self.closing, self.template,
+                                  self.escape, self.nested, self.keep,
+                                  self.adjacent))
+
+    # Stands for the regex where one is expected: in fingerprints, profiles
+    # and messages.
+    pattern = property(__repr__)
+
+# default_formats, as Delimiters: the result is the same.
+default_delimiters = [
+    Delimiters('[', ']', '<font color="gray"><i>{}</i></font>', keep=True),
+    (r'\\\[', r'['),
+    (r'\\\]', r']'),
+
+    Delimiters('{', '}', '<i>({})</i>'),
+    (r'\\\{', r'{'),
+    (r'\\\}', r'}'),
+
+    Delimiters('_', '_', '<i>{}</i>'),
+    (r'\\_', r'_'),
+
+    Delimiters('*', '*', '<b>{}</b>'),
+    (r'\\\*', r'*'),
+
+    Delimiters('``', '``', '<font color="gray">{}</font>'),
+    Delimiters('`', '`', '<font color="red">{}</font>'),
+    (r'\\`', r'`'),
+
+    Delimiters('##', '##', '<font color="green">{}</font>'),
+    Delimiters('#', '#', '<font color="blue">{}</font>'),
+    (r'\\#', r'#'),
+    ]
+
 render_chains = ["default", "card_browser", "mnemogogo"]
 
-def compile_formats(formats):
+# What is needed to format text outside Mnemosyne, e.g., in an exporter or
+# a server, where neither Mnemosyne nor Qt is imported.
+__all__ = ["default_formats", "compile_formats", "fingerprint_formats",
+           "CompiledFormats", "format", "format_html", "format_many",
+           "format_stream", "strip_tags", "thread_tags", "media_spans",
+           "backtracking_risk", "RuleProfile", "rule_profile", "RenderCache",
+           "UnchangedCache", "DiskCache", "disk_cache", "IncrementalRender",
+           "prerender", "Delimiters", "default_delimiters", "Prefetcher"]
+
+##############################################################################
+# Fused rules
+#
+# Most rules have one of two shapes: a pair of delimiters,
+#   ([^\\]|^)OPEN(.*?[^\\])CLOSE     -> \1 pre \2 post
+#   ([^\\]|^)(OPEN.*?[^\\]CLOSE)     -> \1 pre \2 post
+# or escaped characters,
+#   \\X                              -> X
+#   \\(X) or \\([XYZ])               -> \1
+# Consecutive rules of these shapes that cannot see each other's delimiters
+# or output give the same result whether they are applied one after the
+# other or all at once on the original text. Such runs are grouped into a
+# single scanner that finds the delimiters of every rule in one walk over
+# the text and splices in all of the replacements together. Any other rule
+# is applied with regex.sub as before.
+# Two such rules that cannot see each other's delimiters or output at all
+# give the same result in either order, so a rule may also be moved back
+# past rules like that to join an earlier scanner. Nothing is moved past
+# any other rule.
+# A pair of delimiters is always scanned, even on its own: as a regex, an
+# opening delimiter that is never closed makes it try every later position,
+# which takes quadratic time. Escapes alone are left to a regex.
+
+_group1 = r'([^\\]|^)'
+_content = r'.*?[^\\]'
+_metachars = '.^$*+?{}[]|()'
+
+def _parse_literal(ret):
+    chars = []
+    i = 0
+    while i < len(ret):
+        c = ret[i]
+        if c == '\\':
+            i += 1
+            if i == len(ret) or ret[i].isalnum():
+                return None
+            c = ret[i]
+        elif c in _metachars:
+            return None
+        chars.append(c)
+        i += 1
+    return ''.join(chars) or None
+
+def _parse_template(sub):
+    if not sub.startswith('\\1') or sub[2:3].isdigit():
+        return None
+    (pre, sep, post) = sub[2:].partition('\\2')
+    if (not sep or post[:1].isdigit() or '\\' in pre or '\\' in post
+            or not pre or not post):
+        return None
+    return (pre, post)
+
+class _PairRule(object):
+    # Its delimiters never follow a backslash, nor does its output.
+    escape = '\\'
+    after_backslash = frozenset()
+    streams = True
+
+    def __init__(self, index, opening, closing, keep, pre, post):
+        self.index = index
+        self.opening = opening
+        self.closing = closing
+        self.keep = keep
+        self.pre = pre
+        self.post = post
+        self.delims = set(opening + closing)
+        self.outputs = set(pre + post)
+        self.sees = self.delims | set(self.escape)
+        self.triggers = [frozenset(self.delims)]
+
+    def matches(self, text, opens, closes, search=0, at_start=True,
+                final=True, barrier=None):
+        # The (start, end) of the opening and closing delimiters that
+        # regex.finditer would find from search onward, given the positions
+        # of every occurrence of each delimiter. Unless final, more text may
+        # follow, and the position of the first attempt that depends on it
+        # is also returned (or None). If given, the barrier character cuts
+        # the text into parts that are matched as if each were a text of
+        # its own.
+        lo = len(self.opening)
+        lc = len(self.closing)
+        ncloses = len(closes)
+        escape = self.escape
+        base = 0
+        end = None
+
+        def find_close(q):
+            j = bisect.bisect_left(closes, q)
+            while j < ncloses:
+                k = closes[j]
+                if end is not None and k >= end:
+                    break
+                if text[k - 1] != escape:
+                    return k
+                j += 1
+            return None
+
+        results = []
+        nopens = len(opens)
+        if at_start and search == 0:
+            j = 0
+        else:
+            j = bisect.bisect_left(opens, search + 1)
+        while j < nopens:
+            i = opens[j]
+            if barrier is not None and (end is None or i > end):
+                if i > 0 and text[i - 1] == barrier:
+                    base = i
+                else:
+                    base = text.rfind(barrier, 0, i) + 1
+                end = text.find(barrier, i)
+                if end < 0:
+                    end = len(text)
+            if i == base:
+                # At the start, ([^\\]|^) first tries an opening delimiter
+                # at 1 and only then one at 0.
+                k = None
+                if j + 1 < nopens and opens[j + 1] == base + 1:
+                    k = find_close(base + 1 + lo + 1)
+                    if k is not None:
+                        i = base + 1
+                    elif not final:
+                        return (results, 0)
+                elif not final and len(text) < 1 + lo:
+                    return (results, 0)
+                if k is None:
+                    k = find_close(base + lo + 1)
+            elif text[i - 1] == escape:
+                j += 1
+                continue
+            else:
+                k = find_close(i + lo + 1)
+
+            if k is None:
+                # No later opening delimiter can be closed either, at
+                # least until the next part.
+                if not final:
+                    return (results, max(i - 1, 0))
+                if end is None:
+                    break
+                j = bisect.bisect_left(opens, end, j)
+                continue
+
+            results.append((i, i + lo, k, k + lc))
+            j = bisect.bisect_left(opens, k + lc + 1, j)
+
+        return (results, None)
+
+    def edits(self, matches):
+        edits = []
+        for (os, oe, cs, ce) in matches:
+            if self.keep:
+                edits.append((os, 1, os, self.pre))
+                edits.append((ce, 0, ce, self.post))
+            else:
+                edits.append((os, 2, oe, self.pre))
+                edits.append((cs, 2, ce, self.post))
+        return edits
+
+class _DelimiterRule(_PairRule):
+    # The rule of a Delimiters shortcut. Adjacent and nested matches are
+    # found by scans that cannot be resumed, so format_stream() buffers a
+    # scanner with such a rule.
+
+    def __init__(self, index, spec):
+        self.escape = spec.escape
+        _PairRule.__init__(self, index, spec.opening, spec.closing,
+                           spec.keep, spec.pre, spec.post)
+        self.nested = spec.nested
+        self.adjacent = spec.adjacent
+        self.streams = not (self.nested or self.adjacent)
+        if self.escape != '\\':
+            # A backslash may then come before either.
+            self.after_backslash = self.delims | self.outputs
+
+    def matches(self, text, opens, closes, search=0, at_start=True,
+                final=True, barrier=None):
+        if self.nested:
+            return (self._nested_matches(text, opens, closes, barrier), None)
+        if not self.adjacent:
+            return _PairRule.matches(self, text, opens, closes, search,
+                                     at_start, final, barrier)
+
+        lo = len(self.opening)
+        lc = len(self.closing)
+        escape = self.escape
+        base = 0
+        end = len(text) if barrier is None else -1
+        results = []
+        j = 0
+        while j < len(opens):
+            i = opens[j]
+            if i > end:
+                base = text.rfind(barrier, 0, i) + 1
+                end = text.find(barrier, i)
+                if end < 0:
+                    end = len(text)
+            if i > base and text[i - 1] == escape:
+                j += 1
+                continue
+
+            k = None
+            c = bisect.bisect_left(closes, i + lo + 1)
+            while c < len(closes) and closes[c] < end:
+                if text[closes[c] - 1] != escape:
+                    k = closes[c]
+                    break
+                c += 1
+
+            if k is None:
+                # No later opening delimiter can be closed either, at
+                # least until the next part.
+                if end == len(text):
+                    break
+                j = bisect.bisect_left(opens, end, j)
+                continue
+
+            results.append((i, i + lo, k, k + lc))
+            j = bisect.bisect_left(opens, k + lc, j)
+
+        return (results, None)
+
+    def _nested_matches(self, text, opens, closes, barrier):
+        # Walk the delimiters in order: each closing one closes the
+        # innermost opening one still open in the same part of the text.
+        lo = len(self.opening)
+        lc = len(self.closing)
+        escape = self.escape
+        results = []
+        stack = []
+        base = 0
+        end = len(text) if barrier is None else -1
+        after = 0
+        a = b = 0
+        while a < len(opens) or b < len(closes):
+            opening = b == len(closes) or (a < len(opens)
+                                           and opens[a] < closes[b])
+            if opening:
+                i = opens[a]
+                a += 1
+            else:
+                i = closes[b]
+                b += 1
+            if i < after:
+                continue
+            if i > end:
+                stack = []
+                base = text.rfind(barrier, 0, i) + 1
+                end = text.find(barrier, i)
+                if end < 0:
+                    end = len(text)
+            if opening:
+                if i == base or text[i - 1] != escape:
+                    stack.append(i)
+                    after = i + lo
+            elif (stack and i > stack[-1] + lo and text[i - 1] != escape):
+                start = stack.pop()
+                results.append((start, start + lo, i, i + lc))
+                after = i + lc
+        results.sort()
+        return results
+
+class _EscapeRule(object):
+    def __init__(self, index, chars):
+        self.index = index
+        self.chars = chars
+        self.triggers = [frozenset(('\\', c)) for c in chars]
+
+def _commute(a, b):
+    # Whether applying the recognised rules a and b in either order gives
+    # the same result.
+    if isinstance(a, _EscapeRule) and isinstance(b, _EscapeRule):
+        return not set(a.chars) & set(b.chars)
+    if isinstance(b, _EscapeRule):
+        (a, b) = (b, a)
+    if isinstance(a, _EscapeRule):
+        return not (set(a.chars) & (b.delims | b.after_backslash)
+                    or '\\' in b.outputs)
+    return not (a.sees & (b.delims | b.outputs)
+                or b.sees & (a.delims | a.outputs))
+
+def _recognise(index, ret, sub):
+    if ret.startswith(_group1):
+        rest = ret[len(_group1):]
+        keep = rest.startswith('(') and rest.endswith(')')
+        if keep:
+            (opening, sep, closing) = rest[1:-1].partition(_content)
+        else:
+            (opening, sep, closing) = rest.partition('(' + _content + ')')
+        template = _parse_template(sub)
+        if not sep or template is None:
+            return None
+        opening = _parse_literal(opening)
+        closing = _parse_literal(closing)
+        if opening is None or closing is None or '\\' in opening + closing:
+            return None
+        return _PairRule(index, opening, closing, keep,
+                         template[0], template[1])
+
+    elif ret.startswith(r'\\'):
+        char = _parse_literal(ret[2:])
+        if char is not None and len(char) == 1 and sub == char \
+                and char != '\\':
+            return _EscapeRule(index, char)
+        if sub in (r'\1', r'\g<1>'):
+            chars = _escaped_chars(ret)
+            if chars:
+                return _EscapeRule(index, chars)
+
+    return None
+
+def _escaped_chars(ret):
+    # The characters X of a pattern \\(X) or \\([XYZ]) (each a literal other
+    # than a backslash), or None.
+    try:
+        if re.compile(ret).flags & re.IGNORECASE:
+            return None
+        items = list(sre_parse.parse(ret, re.DOTALL))
+    except Exception:
+        return None
+    if (len(items) != 2 or items[0] != (sre_parse.LITERAL, ord('\\'))
+            or items[1][0] != sre_parse.SUBPATTERN):
+        return None
+    av = items[1][1]
+    if av[0] != 1 or (len(av) == 4 and (av[1] or av[2])):
+        return None
+    group = list(av[-1])
+    if len(group) == 1 and group[0][0] == sre_parse.IN:
+        group = group[0][1]
+    elif len(group) != 1:
+        return None
+    chars = []
+    for (op, c) in group:
+        if op != sre_parse.LITERAL or unichr(c) == '\\' or unichr(c) in chars:
+            return None
+        chars.append(unichr(c))
+    return ''.join(chars)
+
+class _Scanner(object):
+    # A scan is linear in the length of the text: never a risk.
+    risk = None
+    quarantined = False
+
+    def __init__(self):
+        self.pairs = []
+        self.escapes = ''
+        self.escape_indexes = {}
+        self.delims = set()
+        self.outputs = set()
+        self.after_backslash = set()
+        self.streams = True
+        self.indexes = []
+        self.triggers = []
+        self.rules = []
+
+    def accepts(self, rule):
+        if isinstance(rule, _PairRule):
+            return (not (rule.sees & (self.delims | self.outputs))
+                    and not (rule.delims & set(self.escapes)))
+        else:
+            return (not set(rule.chars) & set(self.escapes)
+                    and not set(rule.chars) & self.after_backslash
+                    and '\\' not in self.outputs)
+
+    def add(self, rule):
+        if isinstance(rule, _PairRule):
+            self.pairs.append(rule)
+            self.delims |= rule.delims
+            self.outputs |= rule.outputs
+            self.after_backslash |= rule.after_backslash
+            self.streams = self.streams and rule.streams
+        else:
+            self.escapes += rule.chars
+            for c in rule.chars:
+                self.escape_indexes[c] = rule.index
+        self.indexes.append(rule.index)
+        self.triggers.extend(rule.triggers)
+        self.rules.append(rule)
+
+    def finish(self):
+        chars = set(r.opening[0] for r in self.pairs)
+        chars |= set(r.closing[0] for r in self.pairs)
+        if self.escapes:
+            chars.add('\\')
+        self.trigger_re = re.compile(
+            '[' + ''.join(re.escape(c) for c in sorted(chars)) + ']')
+
+    def apply(self, text, counts=None, spans=None, marked=None):
+        # If given, counts maps the index of each rule to its matches. If
+        # given, spans is a sorted list of the (start, end) of regions that
+        # are left alone, as if each were a single character that no rule
+        # uses; it is updated to their places in the result. For a _Marked
+        # text, its barrier character cuts the text into parts that are
+        # formatted as if each were a text of its own.
+        positions = {}
+        if not spans:
+            for m in self.trigger_re.finditer(text):
+                i = m.start()
+                positions.setdefault(text[i], []).append(i)
+            limits = None
+        else:
+            # Delimiters may not run into the next span.
+            limits = {}
+            last = 0
+            for (start, end) in spans + [(len(text), len(text))]:
+                for m in self.trigger_re.finditer(text, last, start):
+                    i = m.start()
+                    positions.setdefault(text[i], []).append(i)
+                    limits[i] = start
+                last = end
+        if not positions:
+            return text
+        barrier = marked.barrier if marked is not None else None
+
+        edits = []
+        for rule in self.pairs:
+            opens = self._occurrences(text, positions, rule.opening, limits)
+            if not opens:
+                continue
+            closes = self._occurrences(text, positions, rule.closing, limits)
+            matches = rule.matches(text, opens, closes, barrier=barrier)[0]
+            edits.extend(rule.edits(matches))
+            if counts is not None:
+                counts[rule.index] = len(matches)
+
+        for i in positions.get('\\', []):
+            if (i + 1 < len(text) and text[i + 1] in self.escapes
+                    and (limits is None or i + 1 < limits[i])):
+                edits.append((i, 2, i + 1, ''))
+                if counts is not None:
+                    index = self.escape_indexes[text[i + 1]]
+                    counts[index] = counts.get(index, 0) + 1
+
+        if not edits:
+            return text
+
+        edits.sort()
+        results = []
+        last = 0
+        for (start, order, end, replacement) in edits:
+            results.append(text[last:start])
+            results.append(replacement)
+            last = end
+        results.append(text[last:])
+
+        if spans:
+            # No edit falls within a span, so each moves by the change in
+            # length made before it.
+            shift = 0
+            j = 0
+            for (k, (start, end)) in enumerate(spans):
+                while j < len(edits) and edits[j][0] <= start:
+                    (s, order, e, replacement) = edits[j]
+                    shift += len(replacement) - (e - s)
+                    j += 1
+                spans[k] = (start + shift, end + shift)
+
+        return ''.join(results)
+
+    def _occurrences(self, text, positions, delim, limits=None):
+        found = positions.get(delim[0], [])
+        if len(delim) == 1:
+            return found
+        if limits is None:
+            return [i for i in found if text.startswith(delim, i)]
+        return [i for i in found if text.startswith(delim, i, limits[i])]
+
+class _Substitution(object):
+    scanner = None
+    risk = None
+    quarantined = False
+
+    def __init__(self, index, regex, subtext, triggers=None):
+        self.index = index
+        self.regex = regex
+        self.subtext = subtext
+        self.triggers = triggers
+        self.indexes = [index]
+
+    def apply(self, text, counts=None, timeout=None, spans=None,
+              marked=None):
+        # With a timeout, the rule is run in another process that is killed
+        # if it takes longer (see format()). With spans, or for a _Marked
+        # text, as for a scanner, which is used when there is one, as it is
+        # to count the matches of each of several rules.
+        # Otherwise, a regex cannot be told to skip parts of the text: the
+        # spans are swapped for characters that appear nowhere else while
+        # it runs, and the parts between barriers are formatted in turn.
+        if self.scanner is not None and (spans or marked is not None
+                or (counts is not None and len(self.indexes) > 1)):
+            return self.scanner.apply(text, counts, spans, marked)
+        if marked is not None and marked.barrier in text:
+            return self._apply_parts(text, counts, timeout, marked.barrier)
+        if spans:
+            (hidden, sentinels) = _hide_spans(text, spans, self.subtext)
+            r = self.apply(hidden, counts, timeout)
+            if r is hidden:
+                return text
+            return _reveal_spans(r, text, spans, sentinels)
+
+        if timeout is not None and _load_multiprocessing():
+            (text, n) = _run_guarded(self.regex, self.subtext, text, timeout)
+        elif counts is None:
+            return self.regex.sub(self.subtext, text)
+        else:
+            (text, n) = self.regex.subn(self.subtext, text)
+        if counts is not None:
+            counts[self.index] = n
+        return text
+
+    def _apply_parts(self, text, counts, timeout, barrier):
+        parts = text.split(barrier)
+        changed = False
+        n = 0
+        for (k, part) in enumerate(parts):
+            if _fires(self.triggers, part, {}):
+                part_counts = {}
+                r = self.apply(part, part_counts, timeout)
+                n += part_counts.get(self.index, 0)
+                if r is not part:
+                    parts[k] = r
+                    changed = True
+        if counts is not None:
+            counts[self.index] = n
+        if not changed:
+            return text
+        return barrier.join(parts)
+
+def _hide_spans(text, spans, subtext):
+    # Replace each span of text by a private-use character found neither in
+    # text nor in the replacement of the rule.
+    present = set(text)
+    present.update(subtext)
+    sentinels = {}
     results = []
-    for (ret, sub) in formats:
+    last = 0
+    c = 0xe000
+    for (k, (start, end)) in enumerate(spans):
+        while unichr(c) in present:
+            c += 1
+        results.append(text[last:start])
+        results.append(unichr(c))
+        sentinels[unichr(c)] = k
+        c += 1
+        last = end
+    results.append(text[last:])
+    return (''.join(results), sentinels)
+
+def _reveal_spans(result, text, spans, sentinels):
+    # Put back the spans hidden by _hide_spans() wherever the rule left
+    # their characters, and update spans to their new places.
+    found = re.compile('[' + ''.join(sentinels) + ']')
+    originals = [text[start:end] for (start, end) in spans]
+    results = []
+    del spans[:]
+    length = 0
+    last = 0
+    for m in found.finditer(result):
+        i = m.start()
+        results.append(result[last:i])
+        length += i - last
+        original = originals[sentinels[result[i]]]
+        results.append(original)
+        spans.append((length, length + len(original)))
+        length += len(original)
+        last = i + 1
+    results.append(result[last:])
+    return ''.join(results)
+
+# The characters that must all appear in a text for a rule to match. These
+# are the literals that are not optional, inside a branch or negated. None
+# means the pattern cannot be analysed and the rule must always run.
+
+def _required_chars(regex):
+    if regex.flags & re.IGNORECASE:
+        return None
+    try:
+        chars = _required(sre_parse.parse(regex.pattern, regex.flags))
+    except Exception:
+        return None
+    return frozenset(chars) if chars else None
+
+_repeats = set(getattr(sre_parse, name) for name in
+               ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+               if hasattr(sre_parse, name))
+
+def _required(items):
+    chars = set()
+    for (op, av) in items:
+        if op == sre_parse.LITERAL:
+            chars.add(unichr(av))
+        elif op == sre_parse.SUBPATTERN:
+            if len(av) == 4 and av[1] & sre_parse.SRE_FLAG_IGNORECASE:
+                raise ValueError
+            chars |= _required(av[-1])
+        elif op in _repeats:
+            if av[0] > 0:
+                chars |= _required(av[2])
+        elif op == sre_parse.BRANCH:
+            branches = [_required(b) for b in av[1]]
+            chars |= set.intersection(*branches)
+        elif op == sre_parse.ASSERT:
+            chars |= _required(av[1])
+        elif op == getattr(sre_parse, 'ATOMIC_GROUP', None):
+            chars |= _required(av)
+    return chars
+
+# Patterns that may backtrack catastrophically. A repetition that can end
+# with another unbounded repetition able to start a fresh iteration, or
+# whose alternatives can start alike, may try exponentially many ways to
+# split a text that it fails to match; two unbounded repetitions in a row
+# over the same characters try quadratically many. The analysis is
+# approximate: characters are compared over a small sample alphabet.
+
+_sample = [unichr(c) for c in range(128)] + [u'\xe9', u'\u3042', u'\u65e5']
+
+_categories = {}
+for (_name, _ret) in (('DIGIT', r'\d'), ('NOT_DIGIT', r'\D'),
+                      ('SPACE', r'\s'), ('NOT_SPACE', r'\S'),
+                      ('WORD', r'\w'), ('NOT_WORD', r'\W')):
+    if hasattr(sre_parse, 'CATEGORY_' + _name):
+        _categories[getattr(sre_parse, 'CATEGORY_' + _name)] = frozenset(
+            c for c in _sample if re.match(_ret, c, re.UNICODE))
+
+def _charset(items):
+    chars = set()
+    negate = False
+    for (op, av) in items:
+        if op == sre_parse.NEGATE:
+            negate = True
+        elif op == sre_parse.LITERAL:
+            chars.add(unichr(av))
+        elif op == sre_parse.RANGE:
+            chars.update(c for c in _sample if av[0] <= ord(c) <= av[1])
+            chars.add(unichr(av[0]))
+        elif op == sre_parse.CATEGORY:
+            chars |= _categories.get(av, set(_sample))
+        else:
+            chars.update(_sample)
+    if negate:
+        return set(_sample) - chars
+    return chars
+
+def _first(items):
+    # The characters that can start a match of items, and whether items
+    # can match the empty string.
+    chars = set()
+    for (op, av) in items:
+        if op == sre_parse.LITERAL:
+            chars.add(unichr(av))
+            return (chars, False)
+        elif op == sre_parse.NOT_LITERAL:
+            chars.update(c for c in _sample if c != unichr(av))
+            return (chars, False)
+        elif op == sre_parse.ANY:
+            chars.update(_sample)
+            return (chars, False)
+        elif op == sre_parse.IN:
+            chars |= _charset(av)
+            return (chars, False)
+        elif op == sre_parse.SUBPATTERN:
+            (first, empty) = _first(av[-1])
+        elif op in _repeats:
+            (first, empty) = _first(av[2])
+            empty = empty or av[0] == 0
+        elif op == sre_parse.BRANCH:
+            firsts = [_first(b) for b in av[1]]
+            first = set().union(*[f for (f, e) in firsts])
+            empty = any(e for (f, e) in firsts)
+        elif op == getattr(sre_parse, 'ATOMIC_GROUP', None):
+            (first, empty) = _first(av)
+        elif op == sre_parse.GROUPREF:
+            (first, empty) = (set(_sample), True)
+        else:
+            (first, empty) = (set(), True)
+        chars |= first
+        if not empty:
+            return (chars, False)
+    return (chars, True)
+
+def _unbounded(op, av):
+    return (op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+            and av[1] == sre_parse.MAXREPEAT)
+
+def _trailing(items):
+    # The unbounded repetitions that can end a match of items.
+    found = []
+    for (op, av) in reversed(items):
+        if _unbounded(op, av):
+            found.append(av[2])
+            found.extend(_trailing(av[2]))
+        elif op == sre_parse.SUBPATTERN:
+            found.extend(_trailing(av[-1]))
+        elif op == sre_parse.BRANCH:
+            for b in av[1]:
+                found.extend(_trailing(b))
+        if not _first([(op, av)])[1]:
+            break
+    return found
+
+def _branches(items):
+    while len(items) == 1 and items[0][0] == sre_parse.SUBPATTERN:
+        items = items[0][1][-1]
+    if len(items) == 1 and items[0][0] == sre_parse.BRANCH:
+        return items[0][1][1]
+    return []
+
+def _risk(items):
+    previous = None
+    for (op, av) in items:
+        if _unbounded(op, av):
+            body = av[2]
+            (first, empty) = _first(body)
+            for inner in _trailing(body):
+                if _first(inner)[0] & first:
+                    return 'nested repetition can take exponential time'
+            starts = [_first(b)[0] for b in _branches(body)]
+            for i in range(len(starts)):
+                for j in range(i):
+                    if starts[i] & starts[j]:
+                        return ('repeated alternatives that start alike can'
+                                ' take exponential time')
+            if previous is not None and previous & first:
+                return 'adjacent repetitions can take quadratic time'
+            previous = first
+            risk = _risk(body)
+        else:
+            if not _first([(op, av)])[1]:
+                previous = None
+            if op == sre_parse.SUBPATTERN:
+                risk = _risk(av[-1])
+            elif op == sre_parse.BRANCH:
+                risk = None
+                for b in av[1]:
+                    risk = risk or _risk(b)
+            elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+                risk = _risk(av[1])
+            else:
+                risk = None
+        if risk:
+            return risk
+    return None
+
+def backtracking_risk(pattern):
+    # None if the pattern looks safe, otherwise why it might not be.
+    try:
+        return _risk(sre_parse.parse(pattern, re.DOTALL))
+    except Exception:
+        return None
+
+class _Pattern(object):
+    # A compiled pattern and, once asked for, what is known about it.
+    # These are shared between compilations through the cache argument of
+    # compile_formats().
+
+    def __init__(self, ret):
+        self.regex = re.compile(ret, re.DOTALL)
+        self.analysed = False
+
+    def analyse(self):
+        if not self.analysed:
+            self.triggers = _required_chars(self.regex)
+            self.risk = backtracking_risk(self.regex.pattern)
+            self.analysed = True
+        return self
+
+def _fuse(compiled, patterns=None):
+    # A recognised rule joins the earliest scanner that accepts it and that
+    # it can be moved back to, or else starts a new one.
+    passes = []
+
+    for (i, (regex, subtext)) in enumerate(compiled):
+        if isinstance(regex, Delimiters):
+            rule = _DelimiterRule(i, regex)
+        else:
+            rule = _recognise(i, regex.pattern, subtext)
+        if rule is None:
+            if patterns is None:
+                pattern = _Pattern(regex.pattern).analyse()
+            else:
+                pattern = patterns[i].analyse()
+            triggers = pattern.triggers
+            p = _Substitution(i, regex, subtext, triggers and [triggers])
+            p.risk = pattern.risk
+            passes.append(p)
+            continue
+
+        target = None
+        for p in reversed(passes):
+            if not isinstance(p, _Scanner):
+                break
+            if p.accepts(rule):
+                target = p
+            if not all(_commute(rule, other) for other in p.rules):
+                break
+        if target is None:
+            target = _Scanner()
+            passes.append(target)
+        target.add(rule)
+
+    for (k, scanner) in enumerate(passes):
+        if not isinstance(scanner, _Scanner):
+            continue
+        scanner.finish()
+        if scanner.pairs:
+            continue
+        if len(scanner.indexes) == 1:
+            # A lone escape is faster as a regex, but format_stream() can
+            # still use the scanner.
+            i = scanner.indexes[0]
+            p = _Substitution(i, compiled[i][0], compiled[i][1],
+                              scanner.triggers)
+            p.scanner = scanner
+            passes[k] = p
+        else:
+            # Only escapes: a single substitution removes the backslash
+            # before any of their characters.
+            regex = re.compile(r'\\([' + ''.join(re.escape(c)
+                               for c in scanner.escapes) + '])')
+            p = _Substitution(scanner.indexes[0], regex, r'\1',
+                              scanner.triggers)
+            p.indexes = scanner.indexes
+            p.scanner = scanner
+            passes[k] = p
+
+    return passes
+
+def _dead_rules(formats):
+    # The (index, reason) of each rule that earlier rules leave little or
+    # nothing to match: one with the same pattern as an earlier rule, which
+    # has already replaced every match, and a pair of delimiters that
+    # contain those of an earlier pair, which takes them first (as would
+    # #...# before ##...##).
+    found = []
+    first = {}
+    pairs = []
+    for (i, rule) in enumerate(formats):
+        (ret, sub) = _rule_source(rule)
+        j = first.setdefault(ret, i)
+        if j != i:
+            if _rule_source(formats[j])[1] == sub:
+                found.append((i, 'repeats rule %d' % (j + 1)))
+            else:
+                found.append((i, 'rule %d has the same pattern' % (j + 1)))
+            continue
+        if isinstance(rule, Delimiters):
+            rule = _DelimiterRule(i, rule)
+        else:
+            rule = _recognise(i, ret, sub)
+        if isinstance(rule, _PairRule):
+            for (j, other) in pairs:
+                if (other.opening in rule.opening
+                        and other.closing in rule.closing):
+                    found.append((i, 'rule %d takes its delimiters first'
+                                     % (j + 1)))
+                    break
+            pairs.append((i, rule))
+    return found
+
+class CompiledFormats(list):
+    # A list of (regex, replacement) pairs, as before, or (Delimiters,
+    # template), together with the passes that format() actually runs, the
+    # rules they were compiled from (source) and a fingerprint of those.
+    # When every pass has known triggers, trigger_re finds any of them; a
+    # text without one is left alone.
+    # Saved is the number of passes saved by fusing rules, and dead lists
+    # the (index, reason) of rules that may never match (see _dead_rules()).
+    # Abandoned counts the texts left partly formatted by a time budget, and
+    # quarantined holds the patterns of the rules it turned off.
+    passes = None
+    saved = 0
+    dead = ()
+    fingerprint = None
+    trigger_re = None
+    free_chars = None
+    abandoned = 0
+    quarantined = ()
+    source = None
+
+def _rule_source(rule):
+    # The (pattern, replacement) of a rule, as text.
+    if isinstance(rule, Delimiters):
+        return (rule.pattern, rule.template)
+    return rule
+
+def fingerprint_formats(formats):
+    h = hashlib.sha1()
+    for rule in formats:
+        (ret, sub) = _rule_source(rule)
+        h.update((u'%s\0%s\0' % (ret, sub)).encode('utf-8'))
+    return h.hexdigest()
+
+def compile_formats(formats, cache=None):
+    # If given, cache is a dictionary from patterns to what was compiled
+    # from them, filled in as needed and kept between calls, so that only
+    # the patterns not seen before are compiled and analysed again.
+    if cache is None:
+        cache = {}
+    results = CompiledFormats()
+    results.source = list(formats)
+    results.fingerprint = fingerprint_formats(formats)
+    patterns = []
+    for rule in formats:
+        if isinstance(rule, Delimiters):
+            results.append((rule, rule.template))
+            patterns.append(None)
+            continue
+        (ret, sub) = rule
         try:
-            cret = re.compile(ret, re.DOTALL)
-            results.append((cret, sub))
-        except re.error as e:
-            pass
+            pattern = cache[ret]
+        except KeyError:
+            try:
+                pattern = _Pattern(ret)
+            except re.error as e:
+                pattern = None
+            cache[ret] = pattern
+        if pattern is not None:
+            results.append((pattern.regex, sub))
+            patterns.append(pattern)
+
+    results.passes = _fuse(results, patterns)
+    results.saved = len(results) - len(results.passes)
+    results.dead = _dead_rules(formats)
+
+    triggers = set()
+    for p in results.passes:
+        if p.triggers is None:
+            break
+        for chars in p.triggers:
+            triggers |= chars
+    else:
+        if triggers:
+            results.trigger_re = re.compile('[' + ''.join(
+                re.escape(c) for c in sorted(triggers)) + ']')
 
     return results
 
 tag_re = re.compile('(<[^>]*>)', re.DOTALL)
 
-def format(text, formats, skip_tags=False):
-    try:
+def _passes(formats):
+    passes = getattr(formats, 'passes', None)
+    if passes is None:
+        passes = [_Substitution(i, regex, subtext)
+                  for (i, (regex, subtext)) in enumerate(formats)]
+    return passes
+
+# Images and sounds are replaced by placeholders before formatting so that
+# their paths are left alone, and then threaded back in afterward. A text
+# without any is passed through as is.
+
+strip_re = re.compile(r'(< *(?:img|audio)[^>]*>)')
+thread_re = re.compile(u'\ufffc([0-9]*)\ufffc')
+
+# A match of tag_re, strip_re or html_tag_re ends at the first '>' after a
+# '<', so none runs past the last '>' of the text. They are only looked for
+# before it: beyond it, an attempt from every stray '<' would scan to the
+# end of the text, which takes quadratic time.
+
+def _tags_end(text):
+    return text.rfind('>') + 1
+
+def _split_tags(regex, text):
+    # regex.split(text), for one of the tag patterns.
+    end = _tags_end(text)
+    if end == len(text):
+        return regex.split(text)
+    texts = regex.split(text[:end])
+    texts[-1] += text[end:]
+    return texts
+
+def media_spans(text):
+    # The (start, end) of each image and sound in text.
+    return [m.span() for m in strip_re.finditer(text, 0, _tags_end(text))]
+
+# Formatting html. The field is read once into tags and the text between
+# them. Tags are never formatted. Inline elements, like <b> or <span>, may be
+# enclosed whole by a shortcut, whose delimiters must then both lie in the
+# same element, so the output stays well nested; any other tag, like <br>
+# or <div>, separates the text on either side as if they were two fields.
+
+html_tag_re = re.compile(r'(<\s*/?\s*([A-Za-z][A-Za-z0-9]*)?[^>]*>)')
+
+inline_tags = frozenset("""a abbr audio b bdi bdo big cite code del dfn em
+    font i img ins kbd mark q rb rp rt rtc ruby s samp small span strike
+    strong sub sup time tt u var wbr""".split())
+
+# Inline elements without content; Mnemosyne never closes <audio>.
+void_tags = frozenset(['img', 'audio', 'wbr'])
+
+private_re = re.compile(u'[\ue000-\uf8ff]')
+# Splits a text on the characters that mark tags (see _Marked).
+mark_re = re.compile(u'([\ue000-\uf8ff])')
+
+def _free_chars(formats, text, n):
+    # The first n private-use characters found neither in text nor in any
+    # replacement, or as many as there are. Those of compiled formats are
+    # only worked out once.
+    free = getattr(formats, 'free_chars', None)
+    if free is None:
+        present = set()
+        for (regex, subtext) in formats:
+            present.update(subtext)
+        free = (c for c in map(unichr, range(0xe000, 0xf900))
+                if c not in present)
+        if isinstance(formats, CompiledFormats):
+            free = formats.free_chars = list(free)
+    if private_re.search(text) is not None:
+        free = (c for c in free if c not in text)
+    return list(itertools.islice(free, n))
+
+class _Marked(object):
+    # The text of an html field with each tag replaced by a private-use
+    # character found neither in the field nor in any replacement, so that
+    # the rules run over a single string. Tags that separate the text share
+    # the barrier character, which no rule ever moves. An inline element,
+    # from its opening tag to its closing one, has a character of its own
+    # and is left alone like a span: a shortcut may enclose it whole, but
+    # none may start inside and end outside, which would cross its tags.
+    # Its content is marked in turn as a child, formatted on its own (see
+    # _format_marked()). Images and sounds are single characters. A closing
+    # tag also closes the elements opened inside it and not yet closed; one
+    # that closes nothing is a barrier. Unless pair_inline, every tag is a
+    # barrier, as is any inline tag beyond the characters available. With
+    # skip_tags, the tags are those of tag_re, all of them barriers, as for
+    # format().
+    tail = ''
+    inline = {}
+    children = {}
+
+    def __init__(self, text, formats, pair_inline=True, skip_tags=False):
+        self.barriers = []
         if skip_tags:
-            results = []
-            texts = tag_re.split(text)
+            self._mark_tags(text, formats)
+            return
+
+        texts = _split_tags(html_tag_re, text)
+        free = _free_chars(formats, text, len(texts) // 3 + 1)
+        self.barrier = free[0]
+        if len(texts) == 1:
+            self.text = text
+            return
+
+        self.inline = {}
+        self.children = {}
+        parts = [texts[0]]
+        stack = [(self, parts, None, None)]
+        k = 1
+        for (tag, name, after) in zip(texts[1::3], texts[2::3], texts[3::3]):
+            (node, parts) = stack[-1][:2]
+            name = (name or '').lower()
+            closing = tag[1:].lstrip().startswith('/')
+            if not (pair_inline and name in inline_tags):
+                node.barriers.append(tag)
+                parts.append(self.barrier)
+            elif closing:
+                depth = len(stack) - 1
+                while depth > 0 and stack[depth][2] != name:
+                    depth -= 1
+                if depth > 0:
+                    for (child, child_parts, _, c) in stack[depth:]:
+                        child.text = ''.join(child_parts)
+                    stack[depth - 1][0].children[stack[depth][3]][2] = tag
+                    del stack[depth:]
+                    (node, parts) = stack[-1][:2]
+                elif name in void_tags:
+                    node.inline[free[k]] = tag
+                    parts.append(free[k])
+                    k += 1
+                else:
+                    node.barriers.append(tag)
+                    parts.append(self.barrier)
+            elif k >= len(free):
+                node.barriers.append(tag)
+                parts.append(self.barrier)
+            elif name in void_tags or tag.rstrip('> ').endswith('/'):
+                node.inline[free[k]] = tag
+                parts.append(free[k])
+                k += 1
+            else:
+                child = _Marked.__new__(_Marked)
+                child.barrier = self.barrier
+                child.barriers = []
+                child.inline = {}
+                child.children = {}
+                node.children[free[k]] = [tag, child, '']
+                parts.append(free[k])
+                stack.append((child, [], name, free[k]))
+                (node, parts) = stack[-1][:2]
+                k += 1
+            parts.append(after)
+        for (node, parts, _, c) in stack:
+            node.text = ''.join(parts)
+
+    def _mark_tags(self, text, formats):
+        texts = _split_tags(tag_re, text)
+        if len(texts) > 1 and texts[-1].startswith('<'):
+            # A '<' that is never closed has always left the rest of the
+            # text, from the tag before it, unformatted (see format()).
+            self.tail = texts[-2] + texts.pop()
+            texts.pop()
+        self.barrier = _free_chars(formats, text, 1)[0]
+        if len(texts) == 1:
+            self.text = texts[0]
+            return
+        self.barriers = texts[1::2]
+        texts[1::2] = [self.barrier] * len(self.barriers)
+        self.text = ''.join(texts)
+
+    def reveal(self, text, children=None):
+        # Put the tags back into text, formatted from self.text, with the
+        # content of each child element formatted as in children (or as it
+        # was, if not there).
+        if self.inline or self.children:
+            texts = mark_re.split(text)
+            for (k, c) in enumerate(texts[1::2], 1):
+                tag = self.inline.get(c)
+                if tag is not None:
+                    texts[2 * k - 1] = tag
+                elif c in self.children:
+                    (opening, child, closing) = self.children[c]
+                    content = children.get(c) if children else None
+                    if content is None:
+                        content = child.reveal(child.text)
+                    texts[2 * k - 1] = opening + content + closing
+            text = ''.join(texts)
+        if self.barriers:
+            texts = text.split(self.barrier)
+            results = [texts[0]]
+            for (tag, part) in zip(self.barriers, texts[1:]):
+                results.append(tag)
+                results.append(part)
+            text = ''.join(results)
+        return text + self.tail
+
+def format_html(text, formats, pair_inline=True, profile=None, budget=None):
+    # Format the text of an html field, leaving its tags alone.
+    marked = _Marked(text, formats, pair_inline)
+    return _format_marked(text, formats, marked, profile, budget)
+
+def _format_marked(text, formats, marked, profile, budget):
+    deadline = None if budget is None else clock() + budget
+    r = _format_node(formats, marked, profile, deadline)
+    return text if r is None else r
+
+def _format_node(formats, marked, profile, deadline):
+    # The formatted text of marked, with the content of each of its child
+    # elements formatted on its own, or None if nothing changed.
+    budget = None if deadline is None else max(deadline - clock(), 0)
+    r = format(marked.text, formats, profile=profile, budget=budget,
+               marked=marked)
+    children = {}
+    for (c, (opening, child, closing)) in marked.children.items():
+        content = _format_node(formats, child, profile, deadline)
+        if content is not None:
+            children[c] = content
+    if r is marked.text and not children:
+        return None
+    return marked.reveal(r, children)
+
+def strip_tags(text):
+    texts = _split_tags(strip_re, text)
+    if len(texts) == 1:
+        return (text, [])
+    tags = []
+    for i in range(1, len(texts), 2):
+        tags.append(texts[i])
+        texts[i] = u'\ufffc%d\ufffc' % ((i - 1) / 2)
+
+    return(''.join(texts), tags)
+
+def thread_tags(text, tags):
+    if not tags:
+        return text
+    texts = thread_re.split(text)
+
+    for i in range(1, len(texts), 2):
+        texts[i] = tags[int(texts[i])]
+
+    return ''.join(texts)
+
+def _fires(triggers, text, seen):
+    # Whether a pass with the given triggers may change text; seen caches
+    # which characters have already been looked for.
+    if triggers is None:
+        return True
+    for chars in triggers:
+        for c in chars:
+            found = seen.get(c)
+            if found is None:
+                found = seen[c] = c in text
+            if not found:
+                break
+        else:
+            return True
+    return False
 
-            for t in texts:
-                if not t.startswith('<'):
-                    for (regex, subtext) in formats:
-                        try:
-                            t = regex.sub(subtext, t)
-                        except re.error as e:
-                            pass
-                results.append(t)
+# Rules that may backtrack catastrophically are run, when format() is
+# given a time budget, in a separate process that can be killed if it
+# overruns. Python cannot interrupt a regex from within.
 
-            return "".join(results)
-        else:
-            for (regex, subtext) in formats:
-                text = regex.sub(subtext, text)
+class _RuleTimeout(Exception):
+    pass
+
+def _load_multiprocessing():
+    # Whether multiprocessing can be used.
+    global multiprocessing, futures, _multiprocessing_loaded
+    if not _multiprocessing_loaded:
+        _multiprocessing_loaded = True
+        try:
+            import multiprocessing
+        except ImportError:
+            multiprocessing = None
+        try:
+            from concurrent import futures
+        except ImportError:
+            futures = None
+    return multiprocessing is not None
+
+_guard_pool = None
+_guard_lock = threading.Lock()
+
+def _guarded_subn(pattern, flags, subtext, text):
+    return re.compile(pattern, flags).subn(subtext, text)
+
+def _run_guarded(regex, subtext, text, timeout):
+    global _guard_pool
+    with _guard_lock:
+        if _guard_pool is None:
+            _guard_pool = multiprocessing.Pool(1)
+        result = _guard_pool.apply_async(_guarded_subn,
+                        (regex.pattern, regex.flags, subtext, text))
+        try:
+            return result.get(max(timeout, 0.001))
+        except multiprocessing.TimeoutError:
+            _guard_pool.terminate()
+            _guard_pool = None
+            raise _RuleTimeout()
+
+def _close_guard():
+    global _guard_pool
+    with _guard_lock:
+        if _guard_pool is not None:
+            _guard_pool.terminate()
+            _guard_pool = None
+
+atexit.register(_close_guard)
+
+# The time allowed to render the sample in the configuration dialog, and
+# how long to wait after an edit before doing so.
+preview_budget = 1.0
+preview_delay = 250
+
+# Fields at least this long are rendered incrementally by the filter (see
+# IncrementalRender), which keeps the renders of the fields of this many
+# cards.
+incremental_chars = 2048
+incremental_fields = 16
+
+# render_window() also formats this many rows on either side of those in
+# view.
+window_margin = 50
+
+# Before the first export through the mnemogogo chain, the fields of the
+# cards to export are formatted in worker processes (see prerender()) when
+# there are at least this many, unless some rule is risky (a worker cannot
+# stop it) or there is only one processor to work on them.
+prerender_fields = 1000
+
+class RuleProfile(object):
+    # The number of times each rule is run, the matches it makes and the
+    # time it takes, keyed on (pattern, replacement) so that the totals
+    # carry over between render chains and recompilations. The time of a
+    # fused pass is shared equally between its rules.
+
+    def __init__(self):
+        self.rules = {}
+
+    def clear(self):
+        self.rules = {}
+
+    def get(self, ret, sub):
+        return tuple(self.rules.get((ret, sub), (0, 0, 0.0)))
+
+    def run(self, formats, p, text, **kwds):
+        counts = {}
+        start = clock()
+        try:
+            return p.apply(text, counts, **kwds)
+        finally:
+            share = (clock() - start) / len(p.indexes)
+            for i in p.indexes:
+                (regex, subtext) = formats[i]
+                stats = self.rules.setdefault((regex.pattern, subtext),
+                                              [0, 0, 0.0])
+                stats[0] += 1
+                stats[1] += counts.get(i, 0)
+                stats[2] += share
+
+rule_profile = RuleProfile()
+
+def format(text, formats, skip_tags=False, profile=None, budget=None,
+           spans=None, marked=None):
+    # If given, spans is a sorted list of the (start, end) of regions of
+    # text that the rules must leave alone, like those of media_spans().
+    # It is not needed with skip_tags, where every tag is left alone and no
+    # match crosses one. Marked is only given by format_html() and with
+    # skip_tags.
+    # If given, profile is a RuleProfile that is updated for every pass run.
+    # If given, budget is the number of seconds that formatting may take.
+    # Once it is spent, no more rules are run and the text formatted so far
+    # is returned. Risky rules (see backtracking_risk()) are run so that
+    # they can be stopped part way; a rule that is stopped, or that alone
+    # takes longer than the budget, is treated as risky from then on, and
+    # one that is stopped is not run again.
+    passes = _passes(formats)
+    trigger_re = getattr(formats, 'trigger_re', None)
+    if trigger_re is not None and trigger_re.search(text) is None:
+        return text
+    if skip_tags and '<' in text:
+        if text.startswith('<') and '>' not in text:
             return text
+        # Every rule runs once over the whole field, tags and all.
+        marked = _Marked(text, formats, skip_tags=True)
+        return _format_marked(text, formats, marked, profile, budget)
+
+    if profile is None:
+        run = lambda p, text, **kwds: p.apply(text, **kwds)
+    else:
+        run = lambda p, text, **kwds: profile.run(formats, p, text, **kwds)
+
+    if budget is None:
+        apply = run
+    else:
+        deadline = clock() + budget
+        def apply(p, text, **kwds):
+            if p.quarantined:
+                return text
+            start = clock()
+            if start >= deadline:
+                raise _RuleTimeout()
+            if p.risk is None:
+                r = run(p, text, **kwds)
+                if clock() - start > budget and isinstance(p, _Substitution):
+                    p.risk = 'took longer than the time budget'
+                return r
+            try:
+                return run(p, text, timeout=deadline - start, **kwds)
+            except _RuleTimeout:
+                p.quarantined = True
+                print("formatting rule abandoned (%s): %s"
+                      % (p.risk, p.regex.pattern))
+                if isinstance(formats, CompiledFormats):
+                    formats.quarantined += (p.regex.pattern,)
+                raise
+
+    try:
+        if spans:
+            spans = list(spans)
+        seen = {}
+        for p in passes:
+            if _fires(p.triggers, text, seen):
+                try:
+                    r = apply(p, text, spans=spans, marked=marked)
+                except re.error as e:
+                    if marked is None and not skip_tags:
+                        raise
+                    # Between tags, a rule that fails is skipped, as it
+                    # always was.
+                    continue
+                if r is not text:
+                    text = r
+                    seen = {}
+        return text
 
     except re.error as e:
         print("formatting error: %s" % e)
         return text
 
+    except _RuleTimeout:
+        if isinstance(formats, CompiledFormats):
+            formats.abandoned += 1
+        return text
+
+##############################################################################
+# Streaming
+#
+# format_stream() formats text that arrives in pieces, like a very large
+# field read from a file, and yields the output as it goes. Each pass only
+# holds back the text that what follows could still change: from the
+# earliest delimiter still waiting to be closed. Rules that are not fused
+# into scanners that can stream need the whole text, which is then buffered
+# and formatted in one go. As in IncrementalRender, each image and sound is
+# fed to the scanners as a single character that no rule uses, and put back
+# as the output goes past.
+
+class _ScannerStream(object):
+    def __init__(self, scanner):
+        self.scanner = scanner
+        self.text = ''
+        self.at_start = True
+        self.searches = [0] * len(scanner.pairs)
+        self.escaped = 0
+        self.edits = []
+
+    def feed(self, data, final):
+        scanner = self.scanner
+        text = self.text + data
+        n = len(text)
+        positions = {}
+        for m in scanner.trigger_re.finditer(text):
+            i = m.start()
+            positions.setdefault(text[i], []).append(i)
+
+        commit = n
+        edits = self.edits
+        for (r, rule) in enumerate(scanner.pairs):
+            opens = scanner._occurrences(text, positions, rule.opening)
+            closes = scanner._occurrences(text, positions, rule.closing)
+            (matches, pending) = rule.matches(text, opens, closes,
+                    self.searches[r], self.at_start, final)
+            if matches:
+                edits.extend(rule.edits(matches))
+                self.searches[r] = matches[-1][3]
+            if not final:
+                if pending is None:
+                    pending = max(self.searches[r], n - len(rule.opening))
+                commit = min(commit, pending)
+
+        escaped = n
+        if scanner.escapes:
+            backslashes = positions.get('\\', [])
+            for i in backslashes[bisect.bisect_left(backslashes,
+                                                    self.escaped):]:
+                if i + 1 < n:
+                    if text[i + 1] in scanner.escapes:
+                        edits.append((i, 2, i + 1, ''))
+                elif not final:
+                    commit = min(commit, i)
+                    escaped = i
+
+        edits.sort()
+        for (start, order, end, replacement) in edits:
+            if start < commit < end:
+                commit = start
+                break
+
+        results = []
+        kept = []
+        last = 0
+        for (start, order, end, replacement) in edits:
+            if start < commit or final:
+                results.append(text[last:start])
+                results.append(replacement)
+                last = end
+            else:
+                kept.append((start - commit, order, end - commit,
+                             replacement))
+        results.append(text[last:commit])
+
+        self.edits = kept
+        self.text = text[commit:]
+        self.searches = [max(search - commit, 0) for search in self.searches]
+        self.escaped = max(escaped - commit, 0)
+        if commit > 0:
+            self.at_start = False
+        return ''.join(results)
+
+    def state(self):
+        return (self.text, self.at_start, tuple(self.searches), self.escaped,
+                tuple(self.edits))
+
+    def restore(self, state):
+        (self.text, self.at_start, searches, self.escaped, edits) = state
+        self.searches = list(searches)
+        self.edits = list(edits)
+
+class _MediaStream(object):
+    # Replaces each image and sound with char, once it is complete, and
+    # queues it to be put back by _UnmediaStream. The rules neither add nor
+    # remove char, so it comes out in the same order as it went in; where
+    # the text holds char itself, that is queued in turn.
+
+    def __init__(self, char):
+        self.char = char
+        self.text = ''
+        self.queue = collections.deque()
+
+    def feed(self, data, final):
+        text = self.text + data
+        cut = len(text)
+        if not final:
+            i = text.find('<', text.rfind('>') + 1)
+            if i >= 0:
+                cut = i
+        self.text = text[cut:]
+        texts = _split_tags(strip_re, text[:cut])
+        for (k, part) in enumerate(texts):
+            if k % 2:
+                self.queue.append(part)
+                texts[k] = self.char
+            else:
+                self.queue.extend(self.char * part.count(self.char))
+        return ''.join(texts)
+
+class _UnmediaStream(object):
+    def __init__(self, media):
+        self.media = media
+
+    def feed(self, data, final):
+        parts = data.split(self.media.char)
+        queue = self.media.queue
+        results = [parts[0]]
+        for part in parts[1:]:
+            results.append(queue.popleft())
+            results.append(part)
+        return ''.join(results)
+
+class _LazyStream(object):
+    # Feeds a stream only once at least as much data is waiting as the
+    # stream holds back. A stream held up, by an opening delimiter that is
+    # never closed, say, would otherwise go over all it holds again with
+    # every chunk; this way each feed costs at most twice the new data, and
+    # the work stays linear in the length of the text. The result is the
+    # same, only handed on in fewer pieces.
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.waiting = []
+        self.size = 0
+
+    def feed(self, data, final):
+        self.waiting.append(data)
+        self.size += len(data)
+        if not final and self.size < len(self.stream.text):
+            return ''
+        data = ''.join(self.waiting)
+        self.waiting = []
+        self.size = 0
+        return self.stream.feed(data, final)
+
+def format_stream(chunks, formats, strip_media=True):
+    # Yield the formatted text of the concatenation of chunks, piece by
+    # piece. The result is the same as with format() on the whole text, with
+    # the spans of media_spans() unless strip_media is False.
+    passes = _passes(formats)
+    scanners = [p if isinstance(p, _Scanner) else p.scanner for p in passes]
+    free = _free_chars(formats, '', 1) if strip_media else [None]
+    if not free or not all(s is not None and s.streams for s in scanners):
+        text = ''.join(chunks)
+        spans = media_spans(text) if strip_media else None
+        if text:
+            yield format(text, formats, spans=spans)
+        return
+
+    streams = [_LazyStream(_ScannerStream(s)) for s in scanners]
+    if strip_media:
+        media = _MediaStream(free[0])
+        streams = [_LazyStream(media)] + streams + [_UnmediaStream(media)]
+
+    def push(data, final):
+        for stream in streams:
+            data = stream.feed(data, final)
+        return data
+
+    for chunk in chunks:
+        result = push(chunk, False)
+        if result:
+            yield result
+    result = push('', True)
+    if result:
+        yield result
+
+##############################################################################
+# Incremental rendering
+#
+# IncrementalRender formats successive versions of a field, as format()
+# does with the spans of media_spans(), and after an edit formats again only
+# what the edit can affect. The text is fed through the streams of
+# format_stream() a segment at a time, and the state of every stream is
+# remembered at the end of each segment. For a new version, formatting
+# resumes from the last of these checkpoints before the first change. Past
+# the last change, it stops at the first checkpoint where the streams are
+# back in the state they were in before: the rest of the text is the same,
+# so the rest of the output is too, and is taken from the previous one.
+# Each image and sound is fed as a single character that no rule uses,
+# which the scanners treat as they would a span. Checkpoints cost about as
+# much again as formatting, so they are only kept once a version shares
+# most of its text with the one before; a field seen once is just
+# formatted.
+
+def _common_prefix(a, b):
+    lo = 0
+    hi = min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a.startswith(b[lo:mid], lo):
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def _common_suffix(a, b, limit):
+    lo = 0
+    hi = min(len(a), len(b), limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a.endswith(b[len(b) - mid:len(b) - lo], 0, len(a) - lo):
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+class IncrementalRender(object):
+    # Only rules that are all fused into scanners can be formatted
+    # incrementally (see supports()); otherwise, render() is just format().
+    # Checkpoints are at most checkpoint_chars apart, at a line break where
+    # there is one. None is kept while the streams hold back more than
+    # max_held characters (after an opening delimiter that is never closed,
+    # say); the text is then formatted to the end in one go.
+
+    checkpoint_chars = 256
+    max_held = 4096
+
+    def __init__(self, formats):
+        self.formats = formats
+        if self.supports(formats):
+            self.scanners = [p if isinstance(p, _Scanner) else p.scanner
+                             for p in _passes(formats)]
+        else:
+            self.scanners = None
+        self.media_char = None
+        self.last = None
+        self.clear()
+
+    @staticmethod
+    def supports(formats):
+        for p in _passes(formats):
+            scanner = p if isinstance(p, _Scanner) else p.scanner
+            if scanner is None or not scanner.streams:
+                return False
+        return True
+
+    def clear(self):
+        self.text = None
+        self.output = None
+        self.checkpoints = []
+
+    def _is_edit(self, text):
+        # Whether text shares at least half of itself with the last version.
+        last = self.last
+        if last is None:
+            return False
+        prefix = _common_prefix(text, last)
+        suffix = _common_suffix(text, last, min(len(text), len(last)) - prefix)
+        return 2 * (prefix + suffix) >= len(text)
+
+    def render(self, text):
+        if self.scanners is None:
+            return format(text, self.formats, spans=media_spans(text))
+        is_edit = self._is_edit(text)
+        self.last = text
+        if not is_edit:
+            self.clear()
+            return format(text, self.formats, spans=media_spans(text))
+
+        texts = _split_tags(strip_re, text)
+        if len(texts) > 1:
+            if self.media_char is None or self.media_char in text:
+                self.media_char = _free_chars(self.formats, text, 1)[0]
+                self.clear()
+            tags = texts[1::2]
+            texts[1::2] = [self.media_char] * len(tags)
+        output = self._render(''.join(texts))
+
+        if len(texts) > 1:
+            parts = output.split(self.media_char)
+            output = ''.join(itertools.chain.from_iterable(
+                zip(parts, tags + [''])))
+        return text if output == text else output
+
+    def _render(self, text):
+        streams = [_ScannerStream(scanner) for scanner in self.scanners]
+
+        def push(data, final):
+            for stream in streams:
+                data = stream.feed(data, final)
+            return data
+
+        def cuts(last, end):
+            while last < end:
+                stop = min(last + self.checkpoint_chars, end)
+                if stop < end:
+                    newline = text.rfind('\n', last + 1, stop)
+                    if newline >= 0:
+                        stop = newline + 1
+                yield (stop, None)
+                last = stop
+
+        if self.text is None:
+            checkpoints = [(0, 0, [s.state() for s in streams])]
+            (start, length, changed, delta) = (0, 0, len(text), 0)
+            ahead = []
+        else:
+            old = self.text
+            prefix = _common_prefix(text, old)
+            changed = len(text) - _common_suffix(
+                text, old, min(len(text), len(old)) - prefix)
+            delta = len(text) - len(old)
+            k = bisect.bisect_right([cp[0] for cp in self.checkpoints],
+                                    prefix) - 1
+            checkpoints = self.checkpoints[:k + 1]
+            (start, length, states) = checkpoints[-1]
+            for (stream, state) in zip(streams, states):
+                stream.restore(state)
+            # The checkpoints of the previous version in the text that
+            # follows the change.
+            ahead = [cp for cp in self.checkpoints[k + 1:]
+                     if cp[0] + delta >= changed]
+
+        results = [self.output[:length]] if length else []
+        targets = itertools.chain(
+            cuts(start, changed),
+            ((i + delta, j) for (j, (i, o, states)) in enumerate(ahead)),
+            cuts(ahead[-1][0] + delta if ahead else changed, len(text)))
+
+        pos = start
+        for (target, j) in targets:
+            if target < pos:
+                continue
+            if target > pos:
+                r = push(text[pos:target], False)
+                results.append(r)
+                length += len(r)
+                pos = target
+                if sum(len(s.text) for s in streams) > self.max_held:
+                    results.append(push(text[pos:], True))
+                    break
+            states = [s.state() for s in streams]
+            if pos != checkpoints[-1][0]:
+                checkpoints.append((pos, length, states))
+            if j is not None and states == ahead[j][2]:
+                # The rest is as before.
+                o = ahead[j][1]
+                results.append(self.output[o:])
+                checkpoints.extend((i + delta, length + oi - o, s)
+                                   for (i, oi, s) in ahead[j + 1:])
+                break
+        else:
+            results.append(push(text[pos:], True))
+
+        self.text = text
+        self.output = ''.join(results)
+        self.checkpoints = checkpoints
+        return self.output
+
+# Formatting many texts at once, possibly over several processes. Workers
+# are sent the rule source and compile it once, keyed on its fingerprint.
+
+_worker_formats = {}
+
+def _format_text(text, formats, mode):
+    (skip_tags, html, skip_media) = mode
+    if html:
+        return format_html(text, formats)
+    if skip_media:
+        return format(text, formats, spans=media_spans(text))
+    return format(text, formats, skip_tags)
+
+def _format_chunk(fingerprint, source, mode, texts):
+    formats = _worker_formats.get(fingerprint)
+    if formats is None:
+        formats = _worker_formats[fingerprint] = compile_formats(source)
+    return [_format_text(text, formats, mode) for text in texts]
+
+def _chunks(texts, size):
+    texts = iter(texts)
+    while True:
+        chunk = list(itertools.islice(texts, size))
+        if not chunk:
+            return
+        yield chunk
+
+def _workers(processes=None):
+    # The number of processes format_many() spreads texts over, or 1 when
+    # it formats them itself.
+    if processes == 1 or not _load_multiprocessing() or futures is None:
+        return 1
+    if processes is None:
+        try:
+            return os.cpu_count() or 1
+        except AttributeError:
+            return multiprocessing.cpu_count()
+    return processes
+
+def format_many(texts, formats, skip_tags=False, processes=1, chunksize=64,
+                html=False, skip_media=False):
+    # Yield format(text, formats, skip_tags) for each of texts, in order,
+    # or format_html(text, formats) if html, or format() with the spans of
+    # media_spans(text) if skip_media, as in the filter.
+    # With processes other than 1, the texts are sent in chunks to a pool
+    # of that many worker processes (None for one per cpu). Only a few
+    # chunks per worker are in flight at once, so results stream back as
+    # texts is consumed.
+    mode = (skip_tags, html, skip_media)
+    processes = _workers(processes)
+    if processes == 1:
+        for text in texts:
+            yield _format_text(text, formats, mode)
+        return
+
+    source = getattr(formats, 'source', None)
+    if source is None:
+        source = [(regex.pattern, subtext) for (regex, subtext) in formats]
+    fingerprint = fingerprint_formats(source)
+
+    executor = futures.ProcessPoolExecutor(processes)
+    pending = collections.deque()
+    try:
+        for chunk in _chunks(texts, chunksize):
+            pending.append(executor.submit(_format_chunk, fingerprint,
+                                           source, mode, chunk))
+            if len(pending) >= 2 * processes:
+                for result in pending.popleft().result():
+                    yield result
+        while pending:
+            for result in pending.popleft().result():
+                yield result
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown()
+
+def prerender(texts, formats, processes=None, chunksize=256,
+              progress=None, **kwds):
+    # Format each distinct text of texts with format_many() (given kwds)
+    # over processes worker processes, and return a dictionary from each to
+    # its formatted text. If given, progress(done, total, seconds) is called
+    # as the results come back, about every tenth, and once at the end.
+    texts = list(set(texts))
+    total = len(texts)
+    step = max(total // 10, chunksize)
+    results = {}
+    start = clock()
+    formatted = format_many(texts, formats, processes=processes,
+                            chunksize=chunksize, **kwds)
+    for (k, result) in enumerate(formatted):
+        results[texts[k]] = result
+        if progress is not None and (k + 1) % step == 0 and k + 1 < total:
+            progress(k + 1, total, clock() - start)
+    if progress is not None:
+        progress(total, total, clock() - start)
+    return results
+
+def print_progress(done, total, seconds):
+    # A progress callback for prerender().
+    print("fast_format: formatted %d of %d fields in %.1f s (%.0f fields/s)"
+          % (done, total, seconds, done / max(seconds, 1e-9)))
+
+class RenderCache(object):
+    # Least-recently used map from (rule fingerprint, text) to formatted
+    # text, bounded by both the number of entries and the total number of
+    # characters held. Fields too big to share the cache are not kept.
+
+    def __init__(self, max_entries=2048, max_chars=4 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        self.entries = collections.OrderedDict()
+        self.chars = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        try:
+            result = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries[key] = result
+        self.hits += 1
+        return result
+
+    def _size(self, key, result):
+        if result is key[1]:
+            return len(result)
+        return len(key[1]) + len(result)
+
+    def put(self, key, result):
+        size = self._size(key, result)
+        if size > self.max_chars // 4:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.chars -= self._size(key, old)
+        self.entries[key] = result
+        self.chars += size
+
+        while (len(self.entries) > self.max_entries
+               or self.chars > self.max_chars):
+            (k, v) = self.entries.popitem(last=False)
+            self.chars -= self._size(k, v)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return { 'entries' : len(self.entries),
+                 'chars'   : self.chars,
+                 'hits'    : self.hits,
+                 'misses'  : self.misses,
+                 'hit_rate': float(self.hits) / lookups if lookups else 0.0 }
+
+    def clear_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def summary(self):
+        # The stats in one line, to help size the cache.
+        stats = self.stats()
+        stats['hit_rate'] *= 100
+        return ("cache: %(entries)d entries, %(chars)d chars, %(hits)d hits, "
+                "%(misses)d misses (%(hit_rate).0f%%)" % stats)
+
+class UnchangedCache(object):
+    # The hashes of texts that the current rules leave unchanged. Only an
+    # int is kept per text, so many more fit than in a RenderCache. When
+    # full, it simply starts again.
+
+    def __init__(self, max_entries=65536):
+        self.max_entries = max_entries
+        self.hashes = set()
+
+    def __contains__(self, text):
+        return hash(text) in self.hashes
+
+    def add(self, text):
+        if len(self.hashes) >= self.max_entries:
+            self.hashes.clear()
+        self.hashes.add(hash(text))
+
+    def clear(self):
+        self.hashes.clear()
+
+class DiskCache(object):
+    # Formatted fields kept in an sqlite file between sessions, keyed on a
+    # digest of the rule fingerprint and the text. The file is only opened
+    # when first needed, rows for other rule sets are dropped whenever the
+    # fingerprint changes, and the least recently used rows are dropped
+    # once there are more than max_entries. Any database error simply
+    # turns the cache off.
+
+    commit_every = 64
+
+    def __init__(self, path, max_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.connection = None
+        self.broken = False
+        self.fingerprint = None
+        self.count = 0
+        self.clock = 0
+        self.pending = 0
+
+    def _connect(self):
+        if self.connection is None and not self.broken:
+            try:
+                con = sqlite3.connect(self.path)
+                con.execute("create table if not exists fast_format_cache "
+                            "(digest text primary key, rules text, "
+                            "result text, used integer)")
+                con.execute("create index if not exists fast_format_used "
+                            "on fast_format_cache (used)")
+                (self.count, self.clock) = con.execute(
+                    "select count(*), coalesce(max(used), 0) "
+                    "from fast_format_cache").fetchone()
+                self.connection = con
+                atexit.register(self.close)
+            except sqlite3.Error as e:
+                self._fail(e)
+        return self.connection
+
+    def _fail(self, e):
+        print("fast_format: disk cache disabled: %s" % e)
+        self.broken = True
+        self.connection = None
+
+    def _digest(self, fingerprint, text):
+        return hashlib.sha1((u'%s\0%s' % (fingerprint, text))
+                            .encode('utf-8')).hexdigest()
+
+    def set_fingerprint(self, fingerprint):
+        if fingerprint == self.fingerprint:
+            return
+        self.fingerprint = fingerprint
+        con = self._connect()
+        if con is None:
+            return
+        try:
+            con.execute("delete from fast_format_cache where rules != ?",
+                        (fingerprint,))
+            con.commit()
+            self.count = con.execute(
+                "select count(*) from fast_format_cache").fetchone()[0]
+        except sqlite3.Error as e:
+            self._fail(e)
+
+    def get(self, fingerprint, text):
+        con = self._connect()
+        if con is None:
+            return None
+        digest = self._digest(fingerprint, text)
+        try:
+            row = con.execute("select result from fast_format_cache "
+                              "where digest = ?", (digest,)).fetchone()
+            if row is None:
+                return None
+            self.clock += 1
+            con.execute("update fast_format_cache set used = ? "
+                        "where digest = ?", (self.clock, digest))
+            self._written()
+            return row[0]
+        except sqlite3.Error as e:
+            self._fail(e)
+            return None
+
+    def put(self, fingerprint, text, result):
+        con = self._connect()
+        if con is None:
+            return
+        self.clock += 1
+        try:
+            if con.execute("insert or replace into fast_format_cache "
+                           "values (?, ?, ?, ?)",
+                           (self._digest(fingerprint, text), fingerprint,
+                            result, self.clock)).rowcount:
+                self.count += 1
+            self._written()
+        except sqlite3.Error as e:
+            self._fail(e)
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        if self.connection is None or not self.pending:
+            return
+        con = self.connection
+        try:
+            if self.count > self.max_entries:
+                con.execute("delete from fast_format_cache where digest in "
+                            "(select digest from fast_format_cache "
+                            "order by used limit ?)",
+                            (self.count - self.max_entries,))
+                self.count = con.execute(
+                    "select count(*) from fast_format_cache").fetchone()[0]
+            con.commit()
+            self.pending = 0
+        except sqlite3.Error as e:
+            self._fail(e)
+
+    def close(self):
+        if self.connection is not None:
+            self.flush()
+            try:
+                self.connection.close()
+            except sqlite3.Error:
+                pass
+            self.connection = None
+
+_disk_caches = {}
+
+def disk_cache(path, max_entries=100000):
+    # One DiskCache per file, shared by the filters of every render chain.
+    cache = _disk_caches.get(path)
+    if cache is None:
+        cache = _disk_caches[path] = DiskCache(path, max_entries)
+    cache.max_entries = max_entries
+    return cache
+
+def _prune_patterns(cache, formats):
+    # Forget the patterns of a compile_formats() cache no longer in formats.
+    used = set(_rule_source(rule)[0] for rule in formats)
+    for ret in list(cache):
+        if ret not in used:
+            del cache[ret]
+
+class RuleRegistry(object):
+    # The compiled rules shared by the filters of every render chain, so
+    # that a change is compiled only once. current is a pair of a
+    # generation, which goes up with every change, and the compiled rules;
+    # it is replaced as a whole, so readers always see a consistent pair.
+    # Rules that a time budget has turned off stay off when the rules
+    # change, until the program is restarted.
+
+    def __init__(self):
+        self.patterns = {}
+        self.quarantined = set()
+        self.lock = threading.Lock()
+        self.current = (0, compile_formats([]))
+
+    def publish(self, formats):
+        # Make formats the current rules, unless they already are, and
+        # return the current pair.
+        with self.lock:
+            (generation, compiled) = self.current
+            if fingerprint_formats(formats) != compiled.fingerprint:
+                self.quarantined.update(compiled.quarantined)
+                compiled = compile_formats(formats, self.patterns)
+                _prune_patterns(self.patterns, formats)
+                for p in _passes(compiled):
+                    if (isinstance(p, _Substitution)
+                            and p.regex.pattern in self.quarantined):
+                        p.quarantined = True
+                        compiled.quarantined += (p.regex.pattern,)
+                self.current = (generation + 1, compiled)
+                if compiled.saved:
+                    print("fast_format: %d rules run in %d passes"
+                          % (len(compiled), len(compiled.passes)))
+                for (i, reason) in compiled.dead:
+                    print("fast_format: rule %d may never match: %s"
+                          % (i + 1, reason))
+            return self.current
+
+rule_registry = RuleRegistry()
+
+class Previewer(object):
+    # Renders sample text in a background thread, so that editing the rules
+    # never waits on them. Only the latest request is rendered: any still
+    # waiting when another arrives are dropped, as is a render overtaken by
+    # a newer request before it starts.
+    # done(generation, html) is called from the worker thread, and the
+    # result is stale unless generation is still self.generation. The
+    # patterns of the rules are compiled once and then taken from a cache.
+    # The thread exits when left idle and is started again when needed.
+
+    idle_timeout = 5.0
+
+    def __init__(self, done, budget=None):
+        self.done = done
+        self.budget = budget
+        self.generation = 0
+        self.request = None
+        self.patterns = {}
+        self.thread = None
+        self.condition = threading.Condition()
+
+    def render(self, text, formats):
+        with self.condition:
+            self.generation += 1
+            self.request = (self.generation, text, list(formats))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+            return self.generation
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if self.request is None:
+                    self.condition.wait(self.idle_timeout)
+                if self.request is None:
+                    self.thread = None
+                    return
+                (generation, text, formats) = self.request
+                self.request = None
+
+            compiled = compile_formats(formats, self.patterns)
+            _prune_patterns(self.patterns, formats)
+
+            if generation != self.generation:
+                continue
+            html = format(text, compiled, budget=self.budget)
+            if generation == self.generation:
+                self.done(generation, html)
+
+class Prefetcher(object):
+    # Formats texts in a background thread before they are needed, like the
+    # fields of the next cards to be reviewed. take() hands over a result
+    # only once it is ready: a filter that finds none formats the text
+    # itself as usual, so nothing ever waits on the thread. Only the latest
+    # batch is worked on: what is left of an earlier one is dropped.
+    # Results are keyed on the fingerprint given with the batch, so those of
+    # other rules are never taken; the oldest are forgotten beyond
+    # max_entries. The thread exits when left idle and is started again
+    # when needed.
+
+    idle_timeout = 5.0
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.pending = collections.deque()
+        self.results = collections.OrderedDict()
+        self.thread = None
+        self.condition = threading.Condition()
+
+    def submit(self, fingerprint, formats, texts, mode):
+        # Format each of texts with formats, as format_many() would in the
+        # given mode (see _format_text()).
+        with self.condition:
+            self.pending = collections.deque(
+                (fingerprint, formats, text, mode) for text in texts
+                if (fingerprint, text) not in self.results)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def take(self, fingerprint, text):
+        # The result for text, if ready, or None.
+        with self.condition:
+            result = self.results.pop((fingerprint, text), None)
+        if result is not None and result == text:
+            return text
+        return result
+
+    def clear(self):
+        with self.condition:
+            self.pending.clear()
+            self.results.clear()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.pending:
+                    self.condition.wait(self.idle_timeout)
+                if not self.pending:
+                    self.thread = None
+                    return
+                (fingerprint, formats, text, mode) = self.pending.popleft()
+                if (fingerprint, text) in self.results:
+                    continue
+
+            try:
+                result = _format_text(text, formats, mode)
+            except Exception as e:
+                print("fast_format: cannot format ahead: %s" % e)
+                continue
+
+            with self.condition:
+                self.results[(fingerprint, text)] = result
+                while len(self.results) > self.max_entries:
+                    self.results.popitem(last=False)
+
+# The fields of the cards coming up in review, formatted ahead.
+review_prefetcher = Prefetcher()
+
 ##############################################################################
 # Mnemosyne 1.x
 if mnemosyne_version == 1:
@@ -216,22 +2611,71 @@ if mnemosyne_version == 1:
                 formats = self.formats
 
             self.compiled_formats = compile_formats(formats)
+            self.budget = config.get('time_budget') or None
+            self.html = config.get('html', False)
+            self.prerender = config.get('prerender', False)
+            self.prerendered = None
+            for rule in formats:
+                if isinstance(rule, Delimiters):
+                    continue
+                risk = backtracking_risk(rule[0])
+                if risk:
+                    print("fast_format: %s: %s" % (rule[0], risk))
+            if self.compiled_formats.saved:
+                print("fast_format: %d rules run in %d passes"
+                      % (len(self.compiled_formats),
+                         len(self.compiled_formats.passes)))
+            for (i, reason) in self.compiled_formats.dead:
+                print("fast_format: %s: may never match: %s"
+                      % (_rule_source(formats[i])[0], reason))
 
             register_function_hook("filter_q", self.run)
             register_function_hook("filter_a", self.run)
-            register_function_hook("gogo_q", self.run)
-            register_function_hook("gogo_a", self.run)
+            register_function_hook("gogo_q", self.run_gogo)
+            register_function_hook("gogo_a", self.run_gogo)
 
         def unload(self):
             unregister_function_hook("filter_q", self.run)
             unregister_function_hook("filter_a", self.run)
-            unregister_function_hook("gogo_q", self.run)
-            unregister_function_hook("gogo_a", self.run)
+            unregister_function_hook("gogo_q", self.run_gogo)
+            unregister_function_hook("gogo_a", self.run_gogo)
+
+        def run_gogo(self, text, card):
+            # With prerender, the first card exported has the cards to
+            # export formatted ahead: those of the active categories, which
+            # Mnemogogo exports from.
+            if card.cat.name in self.exclude_cats:
+                return text
+            if self.prerendered is None:
+                self.prerendered = {}
+                texts = []
+                if self.prerender and _workers() > 1:
+                    for item in get_items():
+                        if (item.cat.active
+                                and item.cat.name not in self.exclude_cats):
+                            texts.extend((item.q, item.a))
+                if (len(texts) >= prerender_fields
+                        and not any(p.risk for p in
+                                    _passes(self.compiled_formats))):
+                    try:
+                        self.prerendered = prerender(texts,
+                            self.compiled_formats, progress=print_progress,
+                            skip_tags=True, html=self.html)
+                    except Exception as e:
+                        print("fast_format: cannot format ahead: %s" % e)
+            result = self.prerendered.get(text)
+            if result is not None:
+                return result
+            return self.run(text, card)
 
         def run(self, text, card):
             if card.cat.name in self.exclude_cats:
                 return text
-            return format(text, self.compiled_formats, skip_tags=True)
+            if self.html:
+                return format_html(text, self.compiled_formats,
+                                   budget=self.budget)
+            return format(text, self.compiled_formats, skip_tags=True,
+                          budget=self.budget)
 
     p = FastFormat()
     p.load()
@@ -240,312 +2684,662 @@ if mnemosyne_version == 1:
 # Mnemosyne 2.x < 2.5
 elif mnemosyne_version == 2:
 
-    strip_re = re.compile(r'(< *(?:img|audio)[^>]*>)')
-    thread_re = re.compile(u'\ufffc([0-9]*)\ufffc')
-
-    def strip_tags(text):
-        texts = strip_re.split(text)
-        tags = []
-        for i in range(1, len(texts), 2):
-            tags.append(texts[i])
-            texts[i] = u'\ufffc%d\ufffc' % ((i - 1) / 2)
-
-        return(''.join(texts), tags)
-
-    def thread_tags(text, tags):
-        texts = thread_re.split(text)
-
-        for i in range(1, len(texts), 2):
-            texts[i] = tags[int(texts[i])]
-
-        return ''.join(texts)
-
     class FastFormatConfig(Hook):
         used_for = "configuration_defaults"
 
         def run(self):
             self.config().setdefault("formats", default_formats)
+            self.config().setdefault("fast_format_cache_entries", 2048)
+            self.config().setdefault("fast_format_cache_chars",
+                                     4 * 1024 * 1024)
+            self.config().setdefault("fast_format_disk_cache", False)
+            self.config().setdefault("fast_format_disk_cache_entries", 100000)
+            self.config().setdefault("fast_format_profile", False)
+            self.config().setdefault("fast_format_time_budget", 0)
+            self.config().setdefault("fast_format_html", False)
+            self.config().setdefault("fast_format_prerender", False)
+            self.config().setdefault("fast_format_prefetch", 0)
+
+    _config_widget = []
+
+    def _define_config_widget():
+        from PyQt4 import QtCore, QtGui
+
+        class FastFormatConfigWdgt(QtGui.QWidget, ConfigurationWidget):
+            name = name
+
+            color_badre = QtGui.QColor(255,0,0)
+            color_goodre = QtGui.QColor(0,255,0)
+            color_unknownre = QtGui.QColor(0,0,0)
+            color_riskyre = QtGui.QColor(255,140,0)
+
+            def __init__(self, component_manager, parent):
+                ConfigurationWidget.__init__(self, component_manager)
+                QtGui.QDialog.__init__(self, self.main_widget())
+                self.vlayout = QtGui.QVBoxLayout(self)
+                self.hlayout = QtGui.QHBoxLayout()
 
-    class FastFormatConfigWdgt(QtGui.QWidget, ConfigurationWidget):
-        name = name
+                try:
+                    formats = self.config()["formats"]
+                except KeyError:
+                    formats = []
+
+                # explanatory label
+                self.hlayout = QtGui.QHBoxLayout()
+
+                self.help_label = QtGui.QLabel(self)
+                self.help_label.setObjectName("help_label")
+                self.help_label.setText(QtGui.QApplication.translate("FastFormat",
+                    help_text, None, QtGui.QApplication.UnicodeUTF8))
+
+                self.hlayout.addWidget(self.help_label)
+                self.vlayout.addLayout(self.hlayout)
+
+                # add match/subst table
+                self.hlayout = QtGui.QHBoxLayout()
+
+                self.formats_table = QtGui.QTableWidget(self)
+                self.formats_table.setAlternatingRowColors(True)
+                self.formats_table.setColumnCount(5)
+                self.formats_table.horizontalHeader().setVisible(True)
+                self.formats_table.setColumnWidth(0, 200)
+                self.formats_table.horizontalHeader().setResizeMode(1,
+                    QtGui.QHeaderView.Stretch)
+                self.formats_table.verticalHeader().setVisible(True)
+                self.formats_table.setObjectName("formatsWidget")
 
-        color_badre = QtGui.QColor(255,0,0)
-        color_goodre = QtGui.QColor(0,255,0)
-        color_unknownre = QtGui.QColor(0,0,0)
+                item = QtGui.QTableWidgetItem()
+                self.formats_table.setHorizontalHeaderItem(0, item)
+                self.formats_table.horizontalHeaderItem(0).setText(\
+                    QtGui.QApplication.translate("FastFormat",
+                        "match", None, QtGui.QApplication.UnicodeUTF8))
 
-        def __init__(self, component_manager, parent):
-            ConfigurationWidget.__init__(self, component_manager)
-            QtGui.QDialog.__init__(self, self.main_widget())
-            self.vlayout = QtGui.QVBoxLayout(self)
-            self.hlayout = QtGui.QHBoxLayout()
+                item = QtGui.QTableWidgetItem()
+                self.formats_table.setHorizontalHeaderItem(1, item)
+                self.formats_table.horizontalHeaderItem(1).setText(\
+                    QtGui.QApplication.translate("FastFormat",
+                        "replacement", None, QtGui.QApplication.UnicodeUTF8))
+
+                # profile columns: calls, matches and time of each rule
+                for (col, title) in ((2, "calls"), (3, "matches"), (4, "ms")):
+                    item = QtGui.QTableWidgetItem()
+                    self.formats_table.setHorizontalHeaderItem(col, item)
+                    self.formats_table.horizontalHeaderItem(col).setText(\
+                        QtGui.QApplication.translate("FastFormat",
+                            title, None, QtGui.QApplication.UnicodeUTF8))
+                    self.formats_table.setColumnWidth(col, 60)
+
+                self.hlayout.addWidget(self.formats_table)
+                self.vlayout.addLayout(self.hlayout)
+
+                # test panels
+                self.hlayout = QtGui.QHBoxLayout()
+
+                self.input_text = QtGui.QTextEdit(self)
+                self.input_text.setMaximumHeight(60)
+                self.output_text = QtGui.QTextEdit(self)
+                self.output_text.setMaximumHeight(60)
+                self.output_text.setReadOnly(True)
+                self.input_text.setPlainText("*test* ``data`` _area_")
+
+                self.hlayout.addWidget(self.input_text)
+                self.hlayout.addWidget(self.output_text)
+
+                self.vlayout.addLayout(self.hlayout)
+
+                # add "add" and "remove" buttons
+                self.hlayout = QtGui.QHBoxLayout()
+
+                self.up_button = QtGui.QToolButton(self)
+                self.up_button.setArrowType(QtCore.Qt.UpArrow)
+
+                self.down_button = QtGui.QToolButton(self)
+                self.down_button.setArrowType(QtCore.Qt.DownArrow)
+
+                self.add_button = QtGui.QPushButton(self)
+                self.add_button.setText(QtGui.QApplication.translate("FastFormat",
+                        "Add", None, QtGui.QApplication.UnicodeUTF8))
+                self.del_button = QtGui.QPushButton(self)
+                self.del_button.setText(QtGui.QApplication.translate("FastFormat",
+                        "Remove", None, QtGui.QApplication.UnicodeUTF8))
+
+                self.profile_check = QtGui.QCheckBox(self)
+                self.profile_check.setText(QtGui.QApplication.translate(
+                        "FastFormat", "Profile rules", None, QtGui.QApplication.UnicodeUTF8))
+                try:
+                    self.profile_check.setChecked(
+                        self.config()["fast_format_profile"])
+                except KeyError: pass
+                self.clear_profile_button = QtGui.QPushButton(self)
+                self.clear_profile_button.setText(
+                        QtGui.QApplication.translate("FastFormat",
+                        "Clear", None, QtGui.QApplication.UnicodeUTF8))
+
+                # hits and misses of the render cache of the review screen
+                self.cache_label = QtGui.QLabel(self)
+                self._update_cache_label()
+
+                self.hlayout.addWidget(self.profile_check)
+                self.hlayout.addWidget(self.clear_profile_button)
+                self.hlayout.addWidget(self.cache_label)
+                self.hlayout.addStretch()
+                self.hlayout.addWidget(self.up_button)
+                self.hlayout.addWidget(self.down_button)
+
+                self.hlayout.addSpacing(40)
+                self.hlayout.addWidget(self.del_button)
+                self.hlayout.addWidget(self.add_button)
+
+                self.vlayout.addLayout(self.hlayout)
+
+                # connect events
+                self.update_sample_text = False
+                self.connect(self.up_button, QtCore.SIGNAL("clicked()"),
+                        self.up_clicked)
+                self.connect(self.down_button, QtCore.SIGNAL("clicked()"),
+                        self.down_clicked)
+                self.connect(self.del_button, QtCore.SIGNAL("clicked()"),
+                        self.del_clicked)
+                self.connect(self.add_button, QtCore.SIGNAL("clicked()"),
+                        self.add_clicked)
+                self.connect(self.clear_profile_button,
+                        QtCore.SIGNAL("clicked()"), self.clear_profile_clicked)
+                self.connect(self.formats_table,
+                    QtCore.SIGNAL("cellChanged(int, int)"), self.cell_changed)
+                self.connect(self.input_text,
+                    QtCore.SIGNAL("textChanged()"), self.input_text_changed)
+
+                # the sample is rendered in the background after a pause
+                self.previewer = Previewer(self._preview_done, preview_budget)
+                self.preview_timer = QtCore.QTimer(self)
+                self.preview_timer.setSingleShot(True)
+                self.preview_timer.setInterval(preview_delay)
+                self.connect(self.preview_timer, QtCore.SIGNAL("timeout()"),
+                        self.update_preview)
+                self.connect(self, QtCore.SIGNAL("previewed"), self.show_preview)
+
+                self._update_formats_table(formats)
+                self.update_sample_text = True
+                self.update_preview()
+
+            def input_text_changed(self):
+                # wait for a pause in typing
+                self.preview_timer.start()
+
+            def update_preview(self):
+                self.previewer.render(unicode(self.input_text.toPlainText()),
+                                      self._table_to_formats())
+
+            def _preview_done(self, generation, html):
+                # called from the worker thread
+                try:
+                    self.emit(QtCore.SIGNAL("previewed"), generation, html)
+                except RuntimeError: pass # the dialog has been closed
 
-            try:
-                formats = self.config()["formats"]
-            except KeyError:
-                formats = []
+            def show_preview(self, generation, html):
+                if generation == self.previewer.generation:
+                    self.output_text.setHtml(html)
 
-            # explanatory label
-            self.hlayout = QtGui.QHBoxLayout()
-
-            self.help_label = QtGui.QLabel(self)
-            self.help_label.setObjectName("help_label")
-            self.help_label.setText(QtGui.QApplication.translate("FastFormat",
-                help_text, None, QtGui.QApplication.UnicodeUTF8))
-
-            self.hlayout.addWidget(self.help_label)
-            self.vlayout.addLayout(self.hlayout)
-
-            # add match/subst table
-            self.hlayout = QtGui.QHBoxLayout()
-
-            self.formats_table = QtGui.QTableWidget(self)
-            self.formats_table.setAlternatingRowColors(True)
-            self.formats_table.setColumnCount(2)
-            self.formats_table.horizontalHeader().setVisible(True)
-            self.formats_table.setColumnWidth(0, 200)
-            self.formats_table.horizontalHeader().setStretchLastSection(True)
-            self.formats_table.verticalHeader().setVisible(True)
-            self.formats_table.setObjectName("formatsWidget")
-
-            item = QtGui.QTableWidgetItem()
-            self.formats_table.setHorizontalHeaderItem(0, item)
-            self.formats_table.horizontalHeaderItem(0).setText(\
-                QtGui.QApplication.translate("FastFormat",
-                    "match", None, QtGui.QApplication.UnicodeUTF8))
-
-            item = QtGui.QTableWidgetItem()
-            self.formats_table.setHorizontalHeaderItem(1, item)
-            self.formats_table.horizontalHeaderItem(1).setText(\
-                QtGui.QApplication.translate("FastFormat",
-                    "replacement", None, QtGui.QApplication.UnicodeUTF8))
-
-            self.hlayout.addWidget(self.formats_table)
-            self.vlayout.addLayout(self.hlayout)
-
-            # test panels
-            self.hlayout = QtGui.QHBoxLayout()
-
-            self.input_text = QtGui.QTextEdit(self)
-            self.input_text.setMaximumHeight(60)
-            self.output_text = QtGui.QTextEdit(self)
-            self.output_text.setMaximumHeight(60)
-            self.output_text.setReadOnly(True)
-            self.input_text.setPlainText("*test* ``data`` _area_")
-
-            self.hlayout.addWidget(self.input_text)
-            self.hlayout.addWidget(self.output_text)
-
-            self.vlayout.addLayout(self.hlayout)
-
-            # add "add" and "remove" buttons
-            self.hlayout = QtGui.QHBoxLayout()
-
-            self.up_button = QtGui.QToolButton(self)
-            self.up_button.setArrowType(QtCore.Qt.UpArrow)
-
-            self.down_button = QtGui.QToolButton(self)
-            self.down_button.setArrowType(QtCore.Qt.DownArrow)
-
-            self.add_button = QtGui.QPushButton(self)
-            self.add_button.setText(QtGui.QApplication.translate("FastFormat",
-                    "Add", None, QtGui.QApplication.UnicodeUTF8))
-            self.del_button = QtGui.QPushButton(self)
-            self.del_button.setText(QtGui.QApplication.translate("FastFormat",
-                    "Remove", None, QtGui.QApplication.UnicodeUTF8))
-
-            self.hlayout.addStretch()
-            self.hlayout.addWidget(self.up_button)
-            self.hlayout.addWidget(self.down_button)
-
-            self.hlayout.addSpacing(40)
-            self.hlayout.addWidget(self.del_button)
-            self.hlayout.addWidget(self.add_button)
-
-            self.vlayout.addLayout(self.hlayout)
-
-            # connect events
-            self.update_sample_text = False
-            self.connect(self.up_button, QtCore.SIGNAL("clicked()"),
-                    self.up_clicked)
-            self.connect(self.down_button, QtCore.SIGNAL("clicked()"),
-                    self.down_clicked)
-            self.connect(self.del_button, QtCore.SIGNAL("clicked()"),
-                    self.del_clicked)
-            self.connect(self.add_button, QtCore.SIGNAL("clicked()"),
-                    self.add_clicked)
-            self.connect(self.formats_table,
-                QtCore.SIGNAL("cellChanged(int, int)"), self.cell_changed)
-            self.connect(self.input_text,
-                QtCore.SIGNAL("textChanged()"), self.input_text_changed)
-
-            self._update_formats_table(formats)
-            self.update_sample_text = True
-            self.input_text_changed()
-
-        def input_text_changed(self):
-            text = self.input_text.toPlainText()
-
-            formats = self._table_to_formats()
-            compiled_formats = compile_formats(formats)
-
-            self.output_text.setHtml(format(unicode(text), compiled_formats))
-
-        def cell_changed(self, row, col):
-            text = unicode(self.input_text.toPlainText())
-
-            if col == 0 or col == 1:
-                item = self.formats_table.item(row, 0)
-                subtext = self.formats_table.item(row, 1)
-                match = unicode(item.text())
-                try:
-                    r = re.compile(match, re.DOTALL)
-                    item.setTextColor(self.color_goodre)
-                    item.setToolTip('')
+            def cell_changed(self, row, col):
+                if col > 1:
+                    return
 
+                if col == 0 or col == 1:
+                    item = self.formats_table.item(row, 0)
+                    subtext = self.formats_table.item(row, 1)
+                    match = unicode(item.text())
                     try:
-                        if r and subtext:
-                            r.sub(unicode(subtext.text()), text)
-                            subtext.setToolTip('')
-                            subtext.setTextColor(self.color_unknownre)
+                        r = re.compile(match, re.DOTALL)
+                        risk = backtracking_risk(match)
+                        if risk:
+                            item.setTextColor(self.color_riskyre)
+                            item.setToolTip(risk)
+                        else:
+                            item.setTextColor(self.color_goodre)
+                            item.setToolTip('')
+
+                        try:
+                            if r and subtext:
+                                # checks the replacement without running the rule
+                                r.sub(unicode(subtext.text()), '')
+                                subtext.setToolTip('')
+                                subtext.setTextColor(self.color_unknownre)
+
+                        except re.error as e:
+                            subtext.setToolTip(unicode(e))
+                            subtext.setTextColor(self.color_badre)
 
                     except re.error as e:
-                        subtext.setToolTip(unicode(e))
-                        subtext.setTextColor(self.color_badre)
+                        item.setToolTip(unicode(e))
+                        item.setTextColor(self.color_badre)
+
+                    self._update_profile(row)
+
+                if self.update_sample_text:
+                    self.input_text_changed()
+
+            def _update_profile(self, row):
+                (match, subst) = self.get_row(row)
+                if match is None or subst is None:
+                    (calls, matches, seconds) = (0, 0, 0.0)
+                else:
+                    (calls, matches, seconds) = rule_profile.get(unicode(match),
+                                                                 unicode(subst))
+
+                for (col, value) in ((2, str(calls)), (3, str(matches)),
+                                     (4, "%.1f" % (seconds * 1000))):
+                    item = QtGui.QTableWidgetItem()
+                    item.setFlags(item.flags() & ~QtCore.Qt.ItemIsEditable)
+                    item.setTextAlignment(QtCore.Qt.AlignRight
+                                          | QtCore.Qt.AlignVCenter)
+                    item.setText(value)
+                    self.formats_table.setItem(row, col, item)
+
+            def clear_profile_clicked(self):
+                rule_profile.clear()
+                for row in range(self.formats_table.rowCount()):
+                    self._update_profile(row)
+                cache = self._review_cache()
+                if cache is not None:
+                    cache.clear_stats()
+                self._update_cache_label()
+
+            def _review_cache(self):
+                try:
+                    chain = self.render_chain("default")
+                    return chain.filter(FastFormat).cache
+                except Exception:
+                    return None
 
-                except re.error as e:
-                    item.setToolTip(unicode(e))
-                    item.setTextColor(self.color_badre)
+            def _update_cache_label(self):
+                cache = self._review_cache()
+                self.cache_label.setText(cache.summary() if cache else "")
 
-            if self.update_sample_text:
-                self.input_text_changed()
+            def add_clicked(self):
+                row = self.formats_table.currentRow()
 
-        def add_clicked(self):
-            row = self.formats_table.currentRow()
+                if row == -1:
+                    self.formats_table.insertRow(self.formats_table.rowCount())
+                else:
+                    self.formats_table.insertRow(row)
 
-            if row == -1:
-                self.formats_table.insertRow(self.formats_table.rowCount())
-            else:
-                self.formats_table.insertRow(row)
+            def del_clicked(self):
+                rows = set()
+                for item in self.formats_table.selectedItems():
+                    rows.add(item.row())
 
-        def del_clicked(self):
-            rows = set()
-            for item in self.formats_table.selectedItems():
-                rows.add(item.row())
+                for row in sorted(rows, reverse=True):
+                    self.formats_table.removeRow(row)
 
-            for row in sorted(rows, reverse=True):
-                self.formats_table.removeRow(row)
+                self.input_text_changed()
 
-            self.input_text_changed()
+            def get_row(self, row):
+                tag_item = self.formats_table.item(row, 0)
+                font_item = self.formats_table.item(row, 1)
 
-        def get_row(self, row):
-            tag_item = self.formats_table.item(row, 0)
-            font_item = self.formats_table.item(row, 1)
+                tag, font, size = None, None, None
+                if tag_item: tag = tag_item.text()
+                if font_item: font = font_item.text()
 
-            tag, font, size = None, None, None
-            if tag_item: tag = tag_item.text()
-            if font_item: font = font_item.text()
+                return (tag, font)
 
-            return (tag, font)
+            def set_row(self, row, tag_font_tuple):
+                tag, font = tag_font_tuple
+                if tag:
+                    tag_item = QtGui.QTableWidgetItem()
+                    tag_item.setText(tag)
+                    self.formats_table.setItem(row, 0, tag_item)
 
-        def set_row(self, row, tag_font_tuple):
-            tag, font = tag_font_tuple
-            if tag:
-                tag_item = QtGui.QTableWidgetItem()
-                tag_item.setText(tag)
-                self.formats_table.setItem(row, 0, tag_item)
+                if font:
+                    font_item = QtGui.QTableWidgetItem()
+                    font_item.setText(font)
+                    self.formats_table.setItem(row, 1, font_item)
 
-            if font:
-                font_item = QtGui.QTableWidgetItem()
-                font_item.setText(font)
-                self.formats_table.setItem(row, 1, font_item)
+            def move_row(self, old_row, new_row):
+                items = self.get_row(old_row)
+                self.formats_table.removeRow(old_row)
+                self.formats_table.insertRow(new_row)
+                self.set_row(new_row, items)
 
-        def move_row(self, old_row, new_row):
-            items = self.get_row(old_row)
-            self.formats_table.removeRow(old_row)
-            self.formats_table.insertRow(new_row)
-            self.set_row(new_row, items)
+            def up_clicked(self):
+                row = self.formats_table.currentRow()
+                if row > 0:
+                    self.move_row(row, row - 1)
+                    self.formats_table.selectRow(row - 1)
 
-        def up_clicked(self):
-            row = self.formats_table.currentRow()
-            if row > 0:
-                self.move_row(row, row - 1)
-                self.formats_table.selectRow(row - 1)
+            def down_clicked(self):
+                row = self.formats_table.currentRow()
+                if row + 1 < self.formats_table.rowCount():
+                    self.move_row(row, row + 1)
+                    self.formats_table.selectRow(row + 1)
 
-        def down_clicked(self):
-            row = self.formats_table.currentRow()
-            if row + 1 < self.formats_table.rowCount():
-                self.move_row(row, row + 1)
-                self.formats_table.selectRow(row + 1)
 
+            def _update_formats_table(self, formats):
+                self.formats_table.setRowCount(len(formats))
 
-        def _update_formats_table(self, formats):
-            self.formats_table.setRowCount(len(formats))
+                i = 0
+                for (match, subst) in formats:
+                    item = QtGui.QTableWidgetItem()
+                    item.setText(match)
+                    self.formats_table.setItem(i, 0, item)
 
-            i = 0
-            for (match, subst) in formats:
-                item = QtGui.QTableWidgetItem()
-                item.setText(match)
-                self.formats_table.setItem(i, 0, item)
+                    item = QtGui.QTableWidgetItem()
+                    item.setText(subst)
+                    self.formats_table.setItem(i, 1, item)
 
-                item = QtGui.QTableWidgetItem()
-                item.setText(subst)
-                self.formats_table.setItem(i, 1, item)
+                    i = i + 1
 
-                i = i + 1
+            def reset_to_defaults(self):
+                self._update_formats_table(default_formats)
 
-        def reset_to_defaults(self):
-            self._update_formats_table(default_formats)
+            def _table_to_formats(self):
+                n_rows = self.formats_table.rowCount()
 
-        def _table_to_formats(self):
-            n_rows = self.formats_table.rowCount()
+                formats = []
+                for i in range(n_rows):
+                    match_item = self.formats_table.item(i, 0)
+                    subst_item = self.formats_table.item(i, 1)
 
-            formats = []
-            for i in range(n_rows):
-                match_item = self.formats_table.item(i, 0)
-                subst_item = self.formats_table.item(i, 1)
+                    if match_item is not None and subst_item is not None:
+                        match = unicode(match_item.text())
+                        subst = unicode(subst_item.text())
+                        formats.append((match, subst))
 
-                if match_item is not None and subst_item is not None:
-                    match = unicode(match_item.text())
-                    subst = unicode(subst_item.text())
-                    formats.append((match, subst))
+                return formats
 
-            return formats
+            def apply(self):
+                self.config()["formats"] = self._table_to_formats()
+                rule_registry.publish(self.config()["formats"])
+                self.config()["fast_format_profile"] = \
+                    self.profile_check.isChecked()
 
-        def apply(self):
-            self.config()["formats"] = self._table_to_formats()
+                for chain in render_chains:
+                    try:
+                        filter = self.render_chain(chain).filter(FastFormat)
+                        filter.reconfigure()
+                    except KeyError: pass
 
-            for chain in render_chains:
-                try:
-                    filter = self.render_chain(chain).filter(FastFormat)
-                    filter.reconfigure()
-                except KeyError: pass
+                self.review_controller().update_dialog(redraw_all=True)
 
-            self.review_controller().update_dialog(redraw_all=True)
+        return FastFormatConfigWdgt
+
+    class FastFormatConfigWdgt(ConfigurationWidget):
+        # Stands in for the widget above, defined on first use.
+        name = name
+
+        def __new__(cls, *args, **kwds):
+            if not _config_widget:
+                _config_widget.append(_define_config_widget())
+            return _config_widget[0](*args, **kwds)
 
     class FastFormat(Filter):
         name = name
         version = version
+        generation = None
         compiled_formats = None
+        fingerprint = None
+        html = False
+        use_incremental = False
+        export_chain = False
+        prerendered = None
+        prefetch_cards = 0
 
         def __init__(self, component_manager):
             Filter.__init__(self, component_manager)
+            try:
+                self.cache = RenderCache(
+                    self.config()["fast_format_cache_entries"],
+                    self.config()["fast_format_cache_chars"])
+            except KeyError:
+                self.cache = RenderCache()
+            self.unchanged = UnchangedCache()
+            self.incremental = collections.OrderedDict()
+            self.disk_cache = None
+            self.profile = None
+            self.budget = None
             self.reconfigure()
 
         def reconfigure(self):
+            # The rules are compiled here only if no other filter has
+            # done so already.
             try:
                 formats = self.config()["formats"]
             except KeyError:
                 formats = []
-            self.compiled_formats = compile_formats(formats)
+            rule_registry.publish(formats)
+
+            try:
+                use_disk_cache = self.config()["fast_format_disk_cache"]
+            except KeyError:
+                use_disk_cache = False
+            if use_disk_cache:
+                config_dir = getattr(self.config(), "config_dir", None) \
+                             or self.config().data_dir
+                self.disk_cache = disk_cache(
+                    os.path.join(config_dir, "fast_format_cache.db"),
+                    self.config()["fast_format_disk_cache_entries"])
+            else:
+                self.disk_cache = None
+            self.generation = None
+
+            # Only fields that are formatted, rather than found in a cache,
+            # are counted.
+            try:
+                use_profile = self.config()["fast_format_profile"]
+            except KeyError:
+                use_profile = False
+            self.profile = rule_profile if use_profile else None
+
+            try:
+                self.budget = self.config()["fast_format_time_budget"] or None
+            except KeyError:
+                self.budget = None
+
+            # With fast_format_html, shortcuts may enclose inline tags
+            # (see format_html()).
+            try:
+                self.html = self.config()["fast_format_html"]
+            except KeyError:
+                self.html = False
+
+            # With fast_format_prefetch, the fields of that many cards to
+            # come are formatted in the background during review.
+            try:
+                self.prefetch_cards = self.config()["fast_format_prefetch"]
+            except KeyError:
+                self.prefetch_cards = 0
+
+        def _update_rules(self, generation, compiled_formats):
+            fingerprint = compiled_formats.fingerprint
+            if self.html:
+                fingerprint += "-html"
+            if fingerprint != self.fingerprint:
+                self.cache.clear()
+                self.unchanged.clear()
+            if self.disk_cache is not None:
+                self.disk_cache.set_fingerprint(fingerprint)
+            self.fingerprint = fingerprint
+            self.generation = generation
+            self.compiled_formats = compiled_formats
+            self.incremental = collections.OrderedDict()
+            self.use_incremental = IncrementalRender.supports(compiled_formats)
+            self.prerendered = None
 
         def run(self, text, card, fact_key, **render_args):
-            (text, tags) = strip_tags(text)
-            return thread_tags(format(text, self.compiled_formats), tags)
+            (generation, compiled_formats) = rule_registry.current
+            if generation != self.generation:
+                self._update_rules(generation, compiled_formats)
+            if text in self.unchanged:
+                return text
+            if self.export_chain:
+                if self.prerendered is None:
+                    self._prerender()
+                result = self.prerendered.get(text)
+                if result is not None:
+                    return result
+            fingerprint = self.fingerprint
+            key = (generation, text)
+            result = self.cache.get(key)
+            if result is None and self.disk_cache is not None:
+                result = self.disk_cache.get(fingerprint, text)
+                if result is not None:
+                    self.cache.put(key, result)
+            if result is None:
+                abandoned = compiled_formats.abandoned
+                quarantined = len(compiled_formats.quarantined)
+                prefetched = None
+                if self.prefetch_cards:
+                    prefetched = review_prefetcher.take(fingerprint, text)
+                if prefetched is not None:
+                    # Formatted while the card before was shown.
+                    result = prefetched
+                elif self.html:
+                    result = format_html(text, compiled_formats,
+                                         profile=self.profile,
+                                         budget=self.budget)
+                elif (self.use_incremental and self.profile is None
+                      and len(text) >= incremental_chars):
+                    # Typically a long field being edited: only what the
+                    # edit can affect is formatted again.
+                    field = (getattr(card, "_id", None), fact_key)
+                    render = self.incremental.pop(field, None)
+                    if render is None:
+                        render = IncrementalRender(compiled_formats)
+                        while len(self.incremental) >= incremental_fields:
+                            self.incremental.popitem(last=False)
+                    self.incremental[field] = render
+                    result = render.render(text)
+                else:
+                    result = format(text, compiled_formats,
+                                    spans=media_spans(text),
+                                    profile=self.profile, budget=self.budget)
+                if compiled_formats.abandoned != abandoned:
+                    # Partly formatted: not worth remembering.
+                    for pattern in compiled_formats.quarantined[quarantined:]:
+                        self.main_widget().show_information(
+                            "fast_format: the rule %s took longer than %s "
+                            "seconds and is turned off until Mnemosyne is "
+                            "restarted." % (pattern, self.budget))
+                    return result
+                if result is text:
+                    self.unchanged.add(text)
+                    return text
+                self.cache.put(key, result)
+                if self.disk_cache is not None:
+                    self.disk_cache.put(fingerprint, text, result)
+            return result
+
+        def _prerender(self):
+            # Format the fields of the cards to export in worker processes,
+            # ahead of the first export through the mnemogogo chain. These
+            # are the active cards, which Mnemogogo exports from.
+            self.prerendered = {}
+            try:
+                enabled = self.config()["fast_format_prerender"]
+            except KeyError:
+                enabled = False
+            if (not enabled or _workers() == 1
+                    or any(p.risk for p in _passes(self.compiled_formats))):
+                return
+            try:
+                texts = [value for (value,) in self.database().con.execute(
+                         """select distinct data_for_fact.value
+                         from data_for_fact join cards
+                         on cards._fact_id = data_for_fact._fact_id
+                         where cards.active = 1""")]
+            except Exception as e:
+                print("fast_format: cannot format ahead: %s" % e)
+                return
+            if len(texts) < prerender_fields:
+                return
+            try:
+                self.prerendered = prerender(texts, self.compiled_formats,
+                    progress=print_progress, html=self.html,
+                    skip_media=not self.html)
+            except Exception as e:
+                print("fast_format: cannot format ahead: %s" % e)
+
+        def prefetch(self):
+            # Hand the fields of the next few cards in the review queue to
+            # review_prefetcher, to be formatted while this one is shown.
+            # The scheduler has no public way to look ahead: SM2Mnemosyne
+            # keeps the internal ids of the cards to come in
+            # _card_ids_in_queue. Its first card is taken and shown as soon
+            # as this hook returns, so run() formats that one itself; the
+            # cards after it are formatted ahead. Risky rules are left to
+            # run() and its time budget.
+            if not self.prefetch_cards:
+                return
+            (generation, compiled_formats) = rule_registry.current
+            if generation != self.generation:
+                self._update_rules(generation, compiled_formats)
+            if any(p.risk for p in _passes(compiled_formats)):
+                return
+            queue = getattr(self.scheduler(), "_card_ids_in_queue", None)
+            if not queue:
+                return
+            texts = []
+            try:
+                for _card_id in list(queue)[1:1 + self.prefetch_cards]:
+                    card = self.database().card(_card_id,
+                                                is_id_internal=True)
+                    texts.extend(card.fact.data.values())
+            except Exception as e:
+                print("fast_format: cannot format ahead: %s" % e)
+                return
+            texts = [text for text in texts if text not in self.unchanged
+                     and (generation, text) not in self.cache]
+            review_prefetcher.submit(self.fingerprint, compiled_formats,
+                                     texts, (False, self.html, not self.html))
+
+        def render_window(self, card_ids, first, last):
+            # A batch entry point for the card browser, which does not call
+            # it yet: format the fields of the cards in rows first to last
+            # of card_ids (internal ids, in the order shown), and of
+            # window_margin rows on either side, in one call. Fields in the
+            # caches already are skipped, and run() finds the others there
+            # afterwards. Risky rules are left to run() and its time budget.
+            (generation, compiled_formats) = rule_registry.current
+            if generation != self.generation:
+                self._update_rules(generation, compiled_formats)
+            if any(p.risk for p in _passes(compiled_formats)):
+                return
+            start = max(first - window_margin, 0)
+            texts = collections.OrderedDict()
+            try:
+                for _card_id in card_ids[start:last + 1 + window_margin]:
+                    card = self.database().card(_card_id,
+                                                is_id_internal=True)
+                    for text in card.fact.data.values():
+                        if (text not in self.unchanged
+                                and (generation, text) not in self.cache):
+                            texts[text] = None
+            except Exception as e:
+                print("fast_format: cannot format ahead: %s" % e)
+                return
+            texts = list(texts)
+            for (text, result) in zip(texts, format_many(texts,
+                    compiled_formats, html=self.html,
+                    skip_media=not self.html)):
+                if result is text:
+                    self.unchanged.add(text)
+                else:
+                    self.cache.put((generation, text), result)
+
+    class FastFormatPrefetch(Hook):
+        # After each card is graded, the next ones are formatted ahead.
+        used_for = "after_repetition"
+
+        def run(self, card=None):
+            try:
+                self.render_chain("default").filter(FastFormat).prefetch()
+            except KeyError: pass
 
     class FastFormatPlugin(Plugin):
         name = name
         description = description
-        components = [FastFormatConfig, FastFormatConfigWdgt, FastFormat]
+        components = [FastFormatConfig, FastFormatConfigWdgt, FastFormat,
+                      FastFormatPrefetch]
 
         def __init__(self, component_manager):
             Plugin.__init__(self, component_manager)
@@ -563,11 +3357,16 @@ elif mnemosyne_version == 2:
                 try:
                     self.render_chain(chain).unregister_filter(FastFormat)
                 except KeyError: pass
+            for cache in _disk_caches.values():
+                cache.close()
+            review_prefetcher.clear()
 
         def new_render_chain(self, name):
             if name in render_chains:
                 self.render_chain(name).register_filter_at_front(FastFormat,
                         ["EscapeToHtml", "EscapeToHtmlForCardBrowser"])
+            if name == "mnemogogo":
+                self.render_chain(name).filter(FastFormat).export_chain = True
 
     # Register plugin.
 
@@ -578,305 +3377,656 @@ elif mnemosyne_version == 2:
 # Mnemosyne 2.x >= 2.5
 elif mnemosyne_version == 2.5:
 
-    strip_re = re.compile(r'(< *(?:img|audio)[^>]*>)')
-    thread_re = re.compile(u'\ufffc([0-9]*)\ufffc')
-
-    def strip_tags(text):
-        texts = strip_re.split(text)
-        tags = []
-        for i in range(1, len(texts), 2):
-            tags.append(texts[i])
-            texts[i] = u'\ufffc%d\ufffc' % ((i - 1) / 2)
-
-        return(''.join(texts), tags)
-
-    def thread_tags(text, tags):
-        texts = thread_re.split(text)
-
-        for i in range(1, len(texts), 2):
-            texts[i] = tags[int(texts[i])]
-
-        return ''.join(texts)
-
     class FastFormatConfig(Hook):
         used_for = "configuration_defaults"
 
         def run(self):
             self.config().setdefault("formats", default_formats)
+            self.config().setdefault("fast_format_cache_entries", 2048)
+            self.config().setdefault("fast_format_cache_chars",
+                                     4 * 1024 * 1024)
+            self.config().setdefault("fast_format_disk_cache", False)
+            self.config().setdefault("fast_format_disk_cache_entries", 100000)
+            self.config().setdefault("fast_format_profile", False)
+            self.config().setdefault("fast_format_time_budget", 0)
+            self.config().setdefault("fast_format_html", False)
+            self.config().setdefault("fast_format_prerender", False)
+            self.config().setdefault("fast_format_prefetch", 0)
 
-    class FastFormatConfigWdgt(QtWidgets.QWidget, ConfigurationWidget):
-        name = name
+    _config_widget = []
 
-        color_badre = QtGui.QColor(255,0,0)
-        color_goodre = QtGui.QColor(0,255,0)
-        color_unknownre = QtGui.QColor(0,0,0)
+    def _define_config_widget():
+        from PyQt5 import QtCore, QtGui, QtWidgets
 
-        def __init__(self, **kwds):
-            super().__init__(**kwds)
-            self.vlayout = QtWidgets.QVBoxLayout(self)
-            self.hlayout = QtWidgets.QHBoxLayout()
+        class FastFormatConfigWdgt(QtWidgets.QWidget, ConfigurationWidget):
+            name = name
 
-            try:
-                formats = self.config()["formats"]
-            except KeyError:
-                formats = []
+            previewed = QtCore.pyqtSignal(int, str)
 
-            # explanatory label
-            self.hlayout = QtWidgets.QHBoxLayout()
+            color_badre = QtGui.QColor(255,0,0)
+            color_goodre = QtGui.QColor(0,255,0)
+            color_unknownre = QtGui.QColor(0,0,0)
+            color_riskyre = QtGui.QColor(255,140,0)
 
-            self.help_label = QtWidgets.QLabel(self)
-            self.help_label.setObjectName("help_label")
-            self.help_label.setText(QtWidgets.QApplication.translate("FastFormat",
-                help_text, None))
-
-            self.hlayout.addWidget(self.help_label)
-            self.vlayout.addLayout(self.hlayout)
-
-            # add match/subst table
-            self.hlayout = QtWidgets.QHBoxLayout()
-
-            self.formats_table = QtWidgets.QTableWidget(self)
-            self.formats_table.setAlternatingRowColors(True)
-            self.formats_table.setColumnCount(2)
-            self.formats_table.horizontalHeader().setVisible(True)
-            self.formats_table.setColumnWidth(0, 200)
-            self.formats_table.horizontalHeader().setStretchLastSection(True)
-            self.formats_table.verticalHeader().setVisible(True)
-            self.formats_table.setObjectName("formatsWidget")
-
-            item = QtWidgets.QTableWidgetItem()
-            self.formats_table.setHorizontalHeaderItem(0, item)
-            self.formats_table.horizontalHeaderItem(0).setText(\
-                QtWidgets.QApplication.translate("FastFormat",
-                    "match", None))
-
-            item = QtWidgets.QTableWidgetItem()
-            self.formats_table.setHorizontalHeaderItem(1, item)
-            self.formats_table.horizontalHeaderItem(1).setText(\
-                QtWidgets.QApplication.translate("FastFormat",
-                    "replacement", None))
-
-            self.hlayout.addWidget(self.formats_table)
-            self.vlayout.addLayout(self.hlayout)
-
-            # test panels
-            self.hlayout = QtWidgets.QHBoxLayout()
-
-            self.input_text = QtWidgets.QTextEdit(self)
-            self.input_text.setMaximumHeight(60)
-            self.output_text = QtWidgets.QTextEdit(self)
-            self.output_text.setMaximumHeight(60)
-            self.output_text.setReadOnly(True)
-            self.input_text.setPlainText("*test* ``data`` _area_")
-
-            self.hlayout.addWidget(self.input_text)
-            self.hlayout.addWidget(self.output_text)
-
-            self.vlayout.addLayout(self.hlayout)
-
-            # add "add" and "remove" buttons
-            self.hlayout = QtWidgets.QHBoxLayout()
-
-            self.up_button = QtWidgets.QToolButton(self)
-            self.up_button.setArrowType(QtCore.Qt.UpArrow)
-
-            self.down_button = QtWidgets.QToolButton(self)
-            self.down_button.setArrowType(QtCore.Qt.DownArrow)
-
-            self.add_button = QtWidgets.QPushButton(self)
-            self.add_button.setText(QtWidgets.QApplication.translate("FastFormat",
-                    "Add", None))
-            self.del_button = QtWidgets.QPushButton(self)
-            self.del_button.setText(QtWidgets.QApplication.translate("FastFormat",
-                    "Remove", None))
-
-            self.hlayout.addStretch()
-            self.hlayout.addWidget(self.up_button)
-            self.hlayout.addWidget(self.down_button)
-
-            self.hlayout.addSpacing(40)
-            self.hlayout.addWidget(self.del_button)
-            self.hlayout.addWidget(self.add_button)
-
-            self.vlayout.addLayout(self.hlayout)
-
-            # connect events
-            self.update_sample_text = False
-            self.up_button.clicked.connect(self.up_clicked)
-            self.down_button.clicked.connect(self.down_clicked)
-            self.del_button.clicked.connect(self.del_clicked)
-            self.add_button.clicked.connect(self.add_clicked)
-            self.formats_table.cellChanged.connect(self.cell_changed)
-            self.input_text.textChanged.connect(self.input_text_changed)
-
-            self._update_formats_table(formats)
-            self.update_sample_text = True
-            self.input_text_changed()
-
-        def input_text_changed(self):
-            text = self.input_text.toPlainText()
-
-            formats = self._table_to_formats()
-            compiled_formats = compile_formats(formats)
-
-            self.output_text.setHtml(format(str(text), compiled_formats))
-
-        def cell_changed(self, row, col):
-            text = str(self.input_text.toPlainText())
-
-            if col == 0 or col == 1:
-                item = self.formats_table.item(row, 0)
-                subtext = self.formats_table.item(row, 1)
-                match = str(item.text())
+            def __init__(self, **kwds):
+                super().__init__(**kwds)
+                self.vlayout = QtWidgets.QVBoxLayout(self)
+                self.hlayout = QtWidgets.QHBoxLayout()
+
+                try:
+                    formats = self.config()["formats"]
+                except KeyError:
+                    formats = []
+
+                # explanatory label
+                self.hlayout = QtWidgets.QHBoxLayout()
+
+                self.help_label = QtWidgets.QLabel(self)
+                self.help_label.setObjectName("help_label")
+                self.help_label.setText(QtWidgets.QApplication.translate("FastFormat",
+                    help_text, None))
+
+                self.hlayout.addWidget(self.help_label)
+                self.vlayout.addLayout(self.hlayout)
+
+                # add match/subst table
+                self.hlayout = QtWidgets.QHBoxLayout()
+
+                self.formats_table = QtWidgets.QTableWidget(self)
+                self.formats_table.setAlternatingRowColors(True)
+                self.formats_table.setColumnCount(5)
+                self.formats_table.horizontalHeader().setVisible(True)
+                self.formats_table.setColumnWidth(0, 200)
+                self.formats_table.horizontalHeader().setSectionResizeMode(1,
+                    QtWidgets.QHeaderView.Stretch)
+                self.formats_table.verticalHeader().setVisible(True)
+                self.formats_table.setObjectName("formatsWidget")
+
+                item = QtWidgets.QTableWidgetItem()
+                self.formats_table.setHorizontalHeaderItem(0, item)
+                self.formats_table.horizontalHeaderItem(0).setText(\
+                    QtWidgets.QApplication.translate("FastFormat",
+                        "match", None))
+
+                item = QtWidgets.QTableWidgetItem()
+                self.formats_table.setHorizontalHeaderItem(1, item)
+                self.formats_table.horizontalHeaderItem(1).setText(\
+                    QtWidgets.QApplication.translate("FastFormat",
+                        "replacement", None))
+
+                # profile columns: calls, matches and time of each rule
+                for (col, title) in ((2, "calls"), (3, "matches"), (4, "ms")):
+                    item = QtWidgets.QTableWidgetItem()
+                    self.formats_table.setHorizontalHeaderItem(col, item)
+                    self.formats_table.horizontalHeaderItem(col).setText(\
+                        QtWidgets.QApplication.translate("FastFormat",
+                            title, None))
+                    self.formats_table.setColumnWidth(col, 60)
+
+                self.hlayout.addWidget(self.formats_table)
+                self.vlayout.addLayout(self.hlayout)
+
+                # test panels
+                self.hlayout = QtWidgets.QHBoxLayout()
+
+                self.input_text = QtWidgets.QTextEdit(self)
+                self.input_text.setMaximumHeight(60)
+                self.output_text = QtWidgets.QTextEdit(self)
+                self.output_text.setMaximumHeight(60)
+                self.output_text.setReadOnly(True)
+                self.input_text.setPlainText("*test* ``data`` _area_")
+
+                self.hlayout.addWidget(self.input_text)
+                self.hlayout.addWidget(self.output_text)
+
+                self.vlayout.addLayout(self.hlayout)
+
+                # add "add" and "remove" buttons
+                self.hlayout = QtWidgets.QHBoxLayout()
+
+                self.up_button = QtWidgets.QToolButton(self)
+                self.up_button.setArrowType(QtCore.Qt.UpArrow)
+
+                self.down_button = QtWidgets.QToolButton(self)
+                self.down_button.setArrowType(QtCore.Qt.DownArrow)
+
+                self.add_button = QtWidgets.QPushButton(self)
+                self.add_button.setText(QtWidgets.QApplication.translate("FastFormat",
+                        "Add", None))
+                self.del_button = QtWidgets.QPushButton(self)
+                self.del_button.setText(QtWidgets.QApplication.translate("FastFormat",
+                        "Remove", None))
+
+                self.profile_check = QtWidgets.QCheckBox(self)
+                self.profile_check.setText(QtWidgets.QApplication.translate(
+                        "FastFormat", "Profile rules", None))
+                try:
+                    self.profile_check.setChecked(
+                        self.config()["fast_format_profile"])
+                except KeyError: pass
+                self.clear_profile_button = QtWidgets.QPushButton(self)
+                self.clear_profile_button.setText(
+                        QtWidgets.QApplication.translate("FastFormat",
+                        "Clear", None))
+
+                # hits and misses of the render cache of the review screen
+                self.cache_label = QtWidgets.QLabel(self)
+                self._update_cache_label()
+
+                self.hlayout.addWidget(self.profile_check)
+                self.hlayout.addWidget(self.clear_profile_button)
+                self.hlayout.addWidget(self.cache_label)
+                self.hlayout.addStretch()
+                self.hlayout.addWidget(self.up_button)
+                self.hlayout.addWidget(self.down_button)
+
+                self.hlayout.addSpacing(40)
+                self.hlayout.addWidget(self.del_button)
+                self.hlayout.addWidget(self.add_button)
+
+                self.vlayout.addLayout(self.hlayout)
+
+                # connect events
+                self.update_sample_text = False
+                self.up_button.clicked.connect(self.up_clicked)
+                self.down_button.clicked.connect(self.down_clicked)
+                self.del_button.clicked.connect(self.del_clicked)
+                self.add_button.clicked.connect(self.add_clicked)
+                self.clear_profile_button.clicked.connect(
+                    self.clear_profile_clicked)
+                self.formats_table.cellChanged.connect(self.cell_changed)
+                self.input_text.textChanged.connect(self.input_text_changed)
+
+                # the sample is rendered in the background after a pause
+                self.previewer = Previewer(self._preview_done, preview_budget)
+                self.preview_timer = QtCore.QTimer(self)
+                self.preview_timer.setSingleShot(True)
+                self.preview_timer.setInterval(preview_delay)
+                self.preview_timer.timeout.connect(self.update_preview)
+                self.previewed.connect(self.show_preview)
+
+                self._update_formats_table(formats)
+                self.update_sample_text = True
+                self.update_preview()
+
+            def input_text_changed(self):
+                # wait for a pause in typing
+                self.preview_timer.start()
+
+            def update_preview(self):
+                self.previewer.render(str(self.input_text.toPlainText()),
+                                      self._table_to_formats())
+
+            def _preview_done(self, generation, html):
+                # called from the worker thread
                 try:
-                    r = re.compile(match, re.DOTALL)
-                    item.setForeground(self.color_goodre)
-                    item.setToolTip('')
+                    self.previewed.emit(generation, html)
+                except RuntimeError: pass # the dialog has been closed
 
+            def show_preview(self, generation, html):
+                if generation == self.previewer.generation:
+                    self.output_text.setHtml(html)
+
+            def cell_changed(self, row, col):
+                if col > 1:
+                    return
+
+                if col == 0 or col == 1:
+                    item = self.formats_table.item(row, 0)
+                    subtext = self.formats_table.item(row, 1)
+                    match = str(item.text())
                     try:
-                        if r and subtext:
-                            r.sub(str(subtext.text()), text)
-                            subtext.setToolTip('')
-                            subtext.setForeground(self.color_unknownre)
+                        r = re.compile(match, re.DOTALL)
+                        risk = backtracking_risk(match)
+                        if risk:
+                            item.setForeground(self.color_riskyre)
+                            item.setToolTip(risk)
+                        else:
+                            item.setForeground(self.color_goodre)
+                            item.setToolTip('')
+
+                        try:
+                            if r and subtext:
+                                # checks the replacement without running the rule
+                                r.sub(str(subtext.text()), '')
+                                subtext.setToolTip('')
+                                subtext.setForeground(self.color_unknownre)
+
+                        except re.error as e:
+                            subtext.setToolTip(str(e))
+                            subtext.setForeground(self.color_badre)
 
                     except re.error as e:
-                        subtext.setToolTip(str(e))
-                        subtext.setForeground(self.color_badre)
+                        item.setToolTip(str(e))
+                        item.setForeground(self.color_badre)
+
+                    self._update_profile(row)
+
+                if self.update_sample_text:
+                    self.input_text_changed()
+
+            def _update_profile(self, row):
+                (match, subst) = self.get_row(row)
+                if match is None or subst is None:
+                    (calls, matches, seconds) = (0, 0, 0.0)
+                else:
+                    (calls, matches, seconds) = rule_profile.get(str(match),
+                                                                 str(subst))
+
+                for (col, value) in ((2, str(calls)), (3, str(matches)),
+                                     (4, "%.1f" % (seconds * 1000))):
+                    item = QtWidgets.QTableWidgetItem()
+                    item.setFlags(item.flags() & ~QtCore.Qt.ItemIsEditable)
+                    item.setTextAlignment(QtCore.Qt.AlignRight
+                                          | QtCore.Qt.AlignVCenter)
+                    item.setText(value)
+                    self.formats_table.setItem(row, col, item)
+
+            def clear_profile_clicked(self):
+                rule_profile.clear()
+                for row in range(self.formats_table.rowCount()):
+                    self._update_profile(row)
+                cache = self._review_cache()
+                if cache is not None:
+                    cache.clear_stats()
+                self._update_cache_label()
+
+            def _review_cache(self):
+                try:
+                    chain = self.render_chain("default")
+                    return chain.filter(FastFormat).cache
+                except Exception:
+                    return None
 
-                except re.error as e:
-                    item.setToolTip(str(e))
-                    item.setForeground(self.color_badre)
+            def _update_cache_label(self):
+                cache = self._review_cache()
+                self.cache_label.setText(cache.summary() if cache else "")
 
-            if self.update_sample_text:
-                self.input_text_changed()
+            def add_clicked(self):
+                row = self.formats_table.currentRow()
 
-        def add_clicked(self):
-            row = self.formats_table.currentRow()
+                if row == -1:
+                    self.formats_table.insertRow(self.formats_table.rowCount())
+                else:
+                    self.formats_table.insertRow(row)
 
-            if row == -1:
-                self.formats_table.insertRow(self.formats_table.rowCount())
-            else:
-                self.formats_table.insertRow(row)
+            def del_clicked(self):
+                rows = set()
+                for item in self.formats_table.selectedItems():
+                    rows.add(item.row())
 
-        def del_clicked(self):
-            rows = set()
-            for item in self.formats_table.selectedItems():
-                rows.add(item.row())
+                for row in sorted(rows, reverse=True):
+                    self.formats_table.removeRow(row)
 
-            for row in sorted(rows, reverse=True):
-                self.formats_table.removeRow(row)
+                self.input_text_changed()
 
-            self.input_text_changed()
+            def get_row(self, row):
+                tag_item = self.formats_table.item(row, 0)
+                font_item = self.formats_table.item(row, 1)
 
-        def get_row(self, row):
-            tag_item = self.formats_table.item(row, 0)
-            font_item = self.formats_table.item(row, 1)
+                tag, font, size = None, None, None
+                if tag_item: tag = tag_item.text()
+                if font_item: font = font_item.text()
 
-            tag, font, size = None, None, None
-            if tag_item: tag = tag_item.text()
-            if font_item: font = font_item.text()
+                return (tag, font)
 
-            return (tag, font)
+            def set_row(self, row, tag_font_tuple):
+                tag, font = tag_font_tuple
+                if tag:
+                    tag_item = QtWidgets.QTableWidgetItem()
+                    tag_item.setText(tag)
+                    self.formats_table.setItem(row, 0, tag_item)
 
-        def set_row(self, row, tag_font_tuple):
-            tag, font = tag_font_tuple
-            if tag:
-                tag_item = QtWidgets.QTableWidgetItem()
-                tag_item.setText(tag)
-                self.formats_table.setItem(row, 0, tag_item)
+                if font:
+                    font_item = QtWidgets.QTableWidgetItem()
+                    font_item.setText(font)
+                    self.formats_table.setItem(row, 1, font_item)
 
-            if font:
-                font_item = QtWidgets.QTableWidgetItem()
-                font_item.setText(font)
-                self.formats_table.setItem(row, 1, font_item)
+            def move_row(self, old_row, new_row):
+                items = self.get_row(old_row)
+                self.formats_table.removeRow(old_row)
+                self.formats_table.insertRow(new_row)
+                self.set_row(new_row, items)
 
-        def move_row(self, old_row, new_row):
-            items = self.get_row(old_row)
-            self.formats_table.removeRow(old_row)
-            self.formats_table.insertRow(new_row)
-            self.set_row(new_row, items)
+            def up_clicked(self):
+                row = self.formats_table.currentRow()
+                if row > 0:
+                    self.move_row(row, row - 1)
+                    self.formats_table.selectRow(row - 1)
 
-        def up_clicked(self):
-            row = self.formats_table.currentRow()
-            if row > 0:
-                self.move_row(row, row - 1)
-                self.formats_table.selectRow(row - 1)
+            def down_clicked(self):
+                row = self.formats_table.currentRow()
+                if row + 1 < self.formats_table.rowCount():
+                    self.move_row(row, row + 1)
+                    self.formats_table.selectRow(row + 1)
 
-        def down_clicked(self):
-            row = self.formats_table.currentRow()
-            if row + 1 < self.formats_table.rowCount():
-                self.move_row(row, row + 1)
-                self.formats_table.selectRow(row + 1)
 
+            def _update_formats_table(self, formats):
+                self.formats_table.setRowCount(len(formats))
 
-        def _update_formats_table(self, formats):
-            self.formats_table.setRowCount(len(formats))
+                i = 0
+                for (match, subst) in formats:
+                    item = QtWidgets.QTableWidgetItem()
+                    item.setText(match)
+                    self.formats_table.setItem(i, 0, item)
 
-            i = 0
-            for (match, subst) in formats:
-                item = QtWidgets.QTableWidgetItem()
-                item.setText(match)
-                self.formats_table.setItem(i, 0, item)
+                    item = QtWidgets.QTableWidgetItem()
+                    item.setText(subst)
+                    self.formats_table.setItem(i, 1, item)
 
-                item = QtWidgets.QTableWidgetItem()
-                item.setText(subst)
-                self.formats_table.setItem(i, 1, item)
+                    i = i + 1
 
-                i = i + 1
+            def reset_to_defaults(self):
+                self._update_formats_table(default_formats)
 
-        def reset_to_defaults(self):
-            self._update_formats_table(default_formats)
+            def _table_to_formats(self):
+                n_rows = self.formats_table.rowCount()
 
-        def _table_to_formats(self):
-            n_rows = self.formats_table.rowCount()
+                formats = []
+                for i in range(n_rows):
+                    match_item = self.formats_table.item(i, 0)
+                    subst_item = self.formats_table.item(i, 1)
 
-            formats = []
-            for i in range(n_rows):
-                match_item = self.formats_table.item(i, 0)
-                subst_item = self.formats_table.item(i, 1)
+                    if match_item is not None and subst_item is not None:
+                        match = str(match_item.text())
+                        subst = str(subst_item.text())
+                        formats.append((match, subst))
 
-                if match_item is not None and subst_item is not None:
-                    match = str(match_item.text())
-                    subst = str(subst_item.text())
-                    formats.append((match, subst))
+                return formats
 
-            return formats
+            def apply(self):
+                self.config()["formats"] = self._table_to_formats()
+                rule_registry.publish(self.config()["formats"])
+                self.config()["fast_format_profile"] = \
+                    self.profile_check.isChecked()
 
-        def apply(self):
-            self.config()["formats"] = self._table_to_formats()
+                for chain in render_chains:
+                    try:
+                        filter = self.render_chain(chain).filter(FastFormat)
+                        filter.reconfigure()
+                    except KeyError: pass
 
-            for chain in render_chains:
-                try:
-                    filter = self.render_chain(chain).filter(FastFormat)
-                    filter.reconfigure()
-                except KeyError: pass
+                self.review_controller().update_dialog(redraw_all=True)
+
+        return FastFormatConfigWdgt
+
+    class FastFormatConfigWdgt(ConfigurationWidget):
+        # Stands in for the widget above, defined on first use.
+        name = name
 
-            self.review_controller().update_dialog(redraw_all=True)
+        def __new__(cls, *args, **kwds):
+            if not _config_widget:
+                _config_widget.append(_define_config_widget())
+            return _config_widget[0](*args, **kwds)
 
     class FastFormat(Filter):
         name = name
         version = version
+        generation = None
         compiled_formats = None
+        fingerprint = None
+        html = False
+        use_incremental = False
+        export_chain = False
+        prerendered = None
+        prefetch_cards = 0
 
         def __init__(self, component_manager):
             Filter.__init__(self, component_manager)
+            try:
+                self.cache = RenderCache(
+                    self.config()["fast_format_cache_entries"],
+                    self.config()["fast_format_cache_chars"])
+            except KeyError:
+                self.cache = RenderCache()
+            self.unchanged = UnchangedCache()
+            self.incremental = collections.OrderedDict()
+            self.disk_cache = None
+            self.profile = None
+            self.budget = None
             self.reconfigure()
 
         def reconfigure(self):
+            # The rules are compiled here only if no other filter has
+            # done so already.
             try:
                 formats = self.config()["formats"]
             except KeyError:
                 formats = []
-            self.compiled_formats = compile_formats(formats)
+            rule_registry.publish(formats)
+
+            try:
+                use_disk_cache = self.config()["fast_format_disk_cache"]
+            except KeyError:
+                use_disk_cache = False
+            if use_disk_cache:
+                config_dir = getattr(self.config(), "config_dir", None) \
+                             or self.config().data_dir
+                self.disk_cache = disk_cache(
+                    os.path.join(config_dir, "fast_format_cache.db"),
+                    self.config()["fast_format_disk_cache_entries"])
+            else:
+                self.disk_cache = None
+            self.generation = None
+
+            # Only fields that are formatted, rather than found in a cache,
+            # are counted.
+            try:
+                use_profile = self.config()["fast_format_profile"]
+            except KeyError:
+                use_profile = False
+            self.profile = rule_profile if use_profile else None
+
+            try:
+                self.budget = self.config()["fast_format_time_budget"] or None
+            except KeyError:
+                self.budget = None
+
+            # With fast_format_html, shortcuts may enclose inline tags
+            # (see format_html()).
+            try:
+                self.html = self.config()["fast_format_html"]
+            except KeyError:
+                self.html = False
+
+            # With fast_format_prefetch, the fields of that many cards to
+            # come are formatted in the background during review.
+            try:
+                self.prefetch_cards = self.config()["fast_format_prefetch"]
+            except KeyError:
+                self.prefetch_cards = 0
+
+        def _update_rules(self, generation, compiled_formats):
+            fingerprint = compiled_formats.fingerprint
+            if self.html:
+                fingerprint += "-html"
+            if fingerprint != self.fingerprint:
+                self.cache.clear()
+                self.unchanged.clear()
+            if self.disk_cache is not None:
+                self.disk_cache.set_fingerprint(fingerprint)
+            self.fingerprint = fingerprint
+            self.generation = generation
+            self.compiled_formats = compiled_formats
+            self.incremental = collections.OrderedDict()
+            self.use_incremental = IncrementalRender.supports(compiled_formats)
+            self.prerendered = None
 
         def run(self, text, card, fact_key, **render_args):
-            (text, tags) = strip_tags(text)
-            return thread_tags(format(text, self.compiled_formats), tags)
+            (generation, compiled_formats) = rule_registry.current
+            if generation != self.generation:
+                self._update_rules(generation, compiled_formats)
+            if text in self.unchanged:
+                return text
+            if self.export_chain:
+                if self.prerendered is None:
+                    self._prerender()
+                result = self.prerendered.get(text)
+                if result is not None:
+                    return result
+            fingerprint = self.fingerprint
+            key = (generation, text)
+            result = self.cache.get(key)
+            if result is None and self.disk_cache is not None:
+                result = self.disk_cache.get(fingerprint, text)
+                if result is not None:
+                    self.cache.put(key, result)
+            if result is None:
+                abandoned = compiled_formats.abandoned
+                quarantined = len(compiled_formats.quarantined)
+                prefetched = None
+                if self.prefetch_cards:
+                    prefetched = review_prefetcher.take(fingerprint, text)
+                if prefetched is not None:
+                    # Formatted while the card before was shown.
+                    result = prefetched
+                elif self.html:
+                    result = format_html(text, compiled_formats,
+                                         profile=self.profile,
+                                         budget=self.budget)
+                elif (self.use_incremental and self.profile is None
+                      and len(text) >= incremental_chars):
+                    # Typically a long field being edited: only what the
+                    # edit can affect is formatted again.
+                    field = (getattr(card, "_id", None), fact_key)
+                    render = self.incremental.pop(field, None)
+                    if render is None:
+                        render = IncrementalRender(compiled_formats)
+                        while len(self.incremental) >= incremental_fields:
+                            self.incremental.popitem(last=False)
+                    self.incremental[field] = render
+                    result = render.render(text)
+                else:
+                    result = format(text, compiled_formats,
+                                    spans=media_spans(text),
+                                    profile=self.profile, budget=self.budget)
+                if compiled_formats.abandoned != abandoned:
+                    # Partly formatted: not worth remembering.
+                    for pattern in compiled_formats.quarantined[quarantined:]:
+                        self.main_widget().show_information(
+                            "fast_format: the rule %s took longer than %s "
+                            "seconds and is turned off until Mnemosyne is "
+                            "restarted." % (pattern, self.budget))
+                    return result
+                if result is text:
+                    self.unchanged.add(text)
+                    return text
+                self.cache.put(key, result)
+                if self.disk_cache is not None:
+                    self.disk_cache.put(fingerprint, text, result)
+            return result
+
+        def _prerender(self):
+            # Format the fields of the cards to export in worker processes,
+            # ahead of the first export through the mnemogogo chain. These
+            # are the active cards, which Mnemogogo exports from.
+            self.prerendered = {}
+            try:
+                enabled = self.config()["fast_format_prerender"]
+            except KeyError:
+                enabled = False
+            if (not enabled or _workers() == 1
+                    or any(p.risk for p in _passes(self.compiled_formats))):
+                return
+            try:
+                texts = [value for (value,) in self.database().con.execute(
+                         """select distinct data_for_fact.value
+                         from data_for_fact join cards
+                         on cards._fact_id = data_for_fact._fact_id
+                         where cards.active = 1""")]
+            except Exception as e:
+                print("fast_format: cannot format ahead: %s" % e)
+                return
+            if len(texts) < prerender_fields:
+                return
+            try:
+                self.prerendered = prerender(texts, self.compiled_formats,
+                    progress=print_progress, html=self.html,
+                    skip_media=not self.html)
+            except Exception as e:
+                print("fast_format: cannot format ahead: %s" % e)
+
+        def prefetch(self):
+            # Hand the fields of the next few cards in the review queue to
+            # review_prefetcher, to be formatted while this one is shown.
+            # The scheduler has no public way to look ahead: SM2Mnemosyne
+            # keeps the internal ids of the cards to come in
+            # _card_ids_in_queue. Its first card is taken and shown as soon
+            # as this hook returns, so run() formats that one itself; the
+            # cards after it are formatted ahead. Risky rules are left to
+            # run() and its time budget.
+            if not self.prefetch_cards:
+                return
+            (generation, compiled_formats) = rule_registry.current
+            if generation != self.generation:
+                self._update_rules(generation, compiled_formats)
+            if any(p.risk for p in _passes(compiled_formats)):
+                return
+            queue = getattr(self.scheduler(), "_card_ids_in_queue", None)
+            if not queue:
+                return
+            texts = []
+            try:
+                for _card_id in list(queue)[1:1 + self.prefetch_cards]:
+                    card = self.database().card(_card_id,
+                                                is_id_internal=True)
+                    texts.extend(card.fact.data.values())
+            except Exception as e:
+                print("fast_format: cannot format ahead: %s" % e)
+                return
+            texts = [text for text in texts if text not in self.unchanged
+                     and (generation, text) not in self.cache]
+            review_prefetcher.submit(self.fingerprint, compiled_formats,
+                                     texts, (False, self.html, not self.html))
+
+        def render_window(self, card_ids, first, last):
+            # A batch entry point for the card browser, which does not call
+            # it yet: format the fields of the cards in rows first to last
+            # of card_ids (internal ids, in the order shown), and of
+            # window_margin rows on either side, in one call. Fields in the
+            # caches already are skipped, and run() finds the others there
+            # afterwards. Risky rules are left to run() and its time budget.
+            (generation, compiled_formats) = rule_registry.current
+            if generation != self.generation:
+                self._update_rules(generation, compiled_formats)
+            if any(p.risk for p in _passes(compiled_formats)):
+                return
+            start = max(first - window_margin, 0)
+            texts = collections.OrderedDict()
+            try:
+                for _card_id in card_ids[start:last + 1 + window_margin]:
+                    card = self.database().card(_card_id,
+                                                is_id_internal=True)
+                    for text in card.fact.data.values():
+                        if (text not in self.unchanged
+                                and (generation, text) not in self.cache):
+                            texts[text] = None
+            except Exception as e:
+                print("fast_format: cannot format ahead: %s" % e)
+                return
+            texts = list(texts)
+            for (text, result) in zip(texts, format_many(texts,
+                    compiled_formats, html=self.html,
+                    skip_media=not self.html)):
+                if result is text:
+                    self.unchanged.add(text)
+                else:
+                    self.cache.put((generation, text), result)
+
+    class FastFormatPrefetch(Hook):
+        # After each card is graded, the next ones are formatted ahead.
+        used_for = "after_repetition"
+
+        def run(self, card=None):
+            try:
+                self.render_chain("default").filter(FastFormat).prefetch()
+            except KeyError: pass
 
     class FastFormatPlugin(Plugin):
         name = name
         description = description
-        components = [FastFormatConfig, FastFormatConfigWdgt, FastFormat]
+        components = [FastFormatConfig, FastFormatConfigWdgt, FastFormat,
+                      FastFormatPrefetch]
 
         supported_API_level = 2
 
@@ -896,11 +4046,16 @@ elif mnemosyne_version == 2.5:
                 try:
                     self.render_chain(chain).unregister_filter(FastFormat)
                 except KeyError: pass
+            for cache in _disk_caches.values():
+                cache.close()
+            review_prefetcher.clear()
 
         def new_render_chain(self, name):
             if name in render_chains:
                 self.render_chain(name).register_filter_at_front(FastFormat,
                         ["EscapeToHtml", "EscapeToHtmlForCardBrowser"])
+            if name == "mnemogogo":
+                self.render_chain(name).filter(FastFormat).export_chain = True
 
     # Register plugin.
 
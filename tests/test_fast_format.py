@@ -0,0 +1,190 @@
+##############################################################################
+#
+# test_fast_format.py
+#
+# Tests that every way fast_format.py has of formatting a field gives the
+# same result as running the rules one after the other with re.sub():
+#   python -m pytest tests
+#
+##############################################################################
+
+import os
+import random
+import re
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import fast_format
+from fast_format import Delimiters
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+# Rules fused into scanners and rules that are not, in between those of
+# default_formats, so that fusing moves rules past each other.
+mixed_formats = [
+    (r'([^\\]|^)~(.*?[^\\])~', r'\1<s>\2</s>'),
+    (r'a+b', r'ab'),
+    ] + fast_format.default_formats[:9] + [
+    Delimiters('%', '%', '<u>{}</u>'),
+    (r'(\w)\1\1', r'\1'),
+    Delimiters('@', '@', '<sup>{}</sup>', keep=True),
+    (r'\\%', r'%'),
+    ] + fast_format.default_formats[9:] + [
+    (r'\\~', r'~'),
+    (r'\\@', r'@'),
+    ]
+
+# Only fused rules, so that format_stream() and IncrementalRender format as
+# they go.
+unfused = [(r'a+b', r'ab'), (r'(\w)\1\1', r'\1')]
+fused_formats = [rule for rule in mixed_formats if rule not in unfused]
+
+pieces = ['a', 'b', 'aa', ' ', '\n', '*', '_', '#', '##', '`', '``', '[',
+          ']', '{', '}', '~', '%', '@', '\\', u'\xe9']
+media = ['<img src="a_b*c.png">', '<audio src="#x#.mp3">', '< img src=_>']
+tags = ['<br>', '<b>', '</b>', '<span class="a_b">', '</span>', '<p>']
+
+def random_text(rnd, size, extra=()):
+    choices = pieces + list(extra)
+    return u''.join(rnd.choice(choices) for i in range(rnd.randrange(size)))
+
+def _regex(rule):
+    # The regex and replacement that a rule stands for (see Delimiters).
+    if not isinstance(rule, Delimiters):
+        return rule
+    (opening, closing) = (re.escape(rule.opening), re.escape(rule.closing))
+    if rule.keep:
+        return (r'([^\\]|^)(%s.*?[^\\]%s)' % (opening, closing),
+                r'\1%s\2%s' % (rule.pre, rule.post))
+    return (r'([^\\]|^)%s(.*?[^\\])%s' % (opening, closing),
+            r'\1%s\2%s' % (rule.pre, rule.post))
+
+def sequential(text, rules):
+    # As the plugin has always compiled the rules.
+    for (regex, subtext) in map(_regex, rules):
+        text = re.sub(regex, subtext, text, flags=re.DOTALL)
+    return text
+
+def sequential_media(text, rules):
+    # Each image and sound is a character that no rule uses.
+    used = set(text)
+    for (regex, subtext) in map(_regex, rules):
+        used.update(subtext)
+    free = (c for c in map(unichr, range(0xe000, 0xf900)) if c not in used)
+    found = {}
+    def hide(m):
+        c = next(free)
+        found[c] = m.group(0)
+        return c
+    text = fast_format.strip_re.sub(hide, text)
+    text = sequential(text, rules)
+    for (c, tag) in found.items():
+        text = text.replace(c, tag)
+    return text
+
+def sequential_skip_tags(text, rules):
+    # The rules run between every two tags.
+    texts = fast_format.tag_re.split(text)
+    for i in range(0, len(texts), 2):
+        texts[i] = sequential(texts[i], rules)
+    return ''.join(texts)
+
+class Formats(unittest.TestCase):
+    # Checks each path for every rule set against its sequential reference.
+
+    rule_sets = [fast_format.default_formats, fast_format.default_delimiters,
+                 mixed_formats]
+    count = 500
+
+    def setUp(self):
+        self.rnd = random.Random(1)
+
+    def compiled(self):
+        for rules in self.rule_sets:
+            yield (rules, fast_format.compile_formats(rules))
+
+    def test_fused(self):
+        for (rules, compiled) in self.compiled():
+            self.assertTrue(compiled.saved > 0)
+            for i in range(self.count):
+                text = random_text(self.rnd, 40)
+                self.assertEqual(fast_format.format(text, compiled),
+                                 sequential(text, rules), repr(text))
+
+    def test_passes(self):
+        # Given as a list of compiled regexes, each rule is a substitution
+        # of its own.
+        for rules in self.rule_sets:
+            regexes = [(re.compile(regex, re.DOTALL), subtext)
+                       for (regex, subtext) in map(_regex, rules)]
+            for i in range(self.count):
+                text = random_text(self.rnd, 40)
+                self.assertEqual(fast_format.format(text, regexes),
+                                 sequential(text, rules), repr(text))
+
+    def test_spans(self):
+        for (rules, compiled) in self.compiled():
+            for i in range(self.count):
+                text = random_text(self.rnd, 40, media)
+                spans = fast_format.media_spans(text)
+                self.assertEqual(
+                    fast_format.format(text, compiled, spans=spans),
+                    sequential_media(text, rules), repr(text))
+
+    def test_skip_tags(self):
+        for (rules, compiled) in self.compiled():
+            for i in range(self.count):
+                text = random_text(self.rnd, 40, tags + media)
+                self.assertEqual(
+                    fast_format.format(text, compiled, skip_tags=True),
+                    sequential_skip_tags(text, rules), repr(text))
+
+    def test_html_barriers(self):
+        # With no inline elements paired, every tag separates the text.
+        for (rules, compiled) in self.compiled():
+            for i in range(self.count):
+                text = random_text(self.rnd, 40, ['<br>', '<p>', '</p>'])
+                self.assertEqual(
+                    fast_format.format_html(text, compiled,
+                                            pair_inline=False),
+                    sequential_skip_tags(text, rules), repr(text))
+
+    def test_stream(self):
+        for rules in self.rule_sets + [fused_formats]:
+            compiled = fast_format.compile_formats(rules)
+            for i in range(self.count // 4):
+                text = random_text(self.rnd, 80, media)
+                cuts = sorted(self.rnd.randrange(len(text) + 1)
+                              for j in range(self.rnd.randrange(6)))
+                chunks = [text[a:b] for (a, b)
+                          in zip([0] + cuts, cuts + [len(text)])]
+                self.assertEqual(
+                    u''.join(fast_format.format_stream(chunks, compiled)),
+                    sequential_media(text, rules), repr(chunks))
+                self.assertEqual(
+                    u''.join(fast_format.format_stream(chunks, compiled,
+                                                       strip_media=False)),
+                    sequential(text, rules), repr(chunks))
+
+    def test_incremental(self):
+        for rules in [fast_format.default_formats,
+                      fast_format.default_delimiters, fused_formats]:
+            compiled = fast_format.compile_formats(rules)
+            render = fast_format.IncrementalRender(compiled)
+            self.assertTrue(render.scanners is not None)
+            text = random_text(self.rnd, 2000, media)
+            for i in range(self.count // 10):
+                start = self.rnd.randrange(len(text) + 1)
+                end = min(len(text), start + self.rnd.randrange(8))
+                text = (text[:start] + random_text(self.rnd, 8, media)
+                        + text[end:])
+                self.assertEqual(render.render(text),
+                                 sequential_media(text, rules), repr(text))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+##############################################################################
+#
+# test_format_deck.py
+#
+# Tests for tools/format_deck.py:  python -m pytest tests
+#
+##############################################################################
+
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'tools'))
+import format_deck
+
+formats = format_deck.fast_format.compile_formats(
+    format_deck.fast_format.default_formats)
+
+class XmlRoundTrip(unittest.TestCase):
+
+    def format_xml(self, data):
+        (fd, path) = tempfile.mkstemp(suffix='.xml')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            out = io.BytesIO()
+            records = format_deck.read_xml(format_deck.Source(path), 'utf-8',
+                                           ['Q', 'A'])
+            write = format_deck.write_xml(out, 'utf-8')
+            for record in format_deck.format_records(records, formats,
+                                                     processes=1):
+                write(record)
+            return out.getvalue()
+        finally:
+            os.remove(path)
+
+    def test_entities(self):
+        data = (b'<card><Q>*b* &amp; &quot;x&quot; &#233;</Q>'
+                b'<A>&quot;y&quot; &#233;</A></card>')
+        self.assertEqual(self.format_xml(data),
+                         b'<card><Q>&lt;b&gt;b&lt;/b&gt; &amp; &quot;x&quot; '
+                         b'\xc3\xa9</Q><A>&quot;y&quot; &#233;</A></card>')
+
+    def test_round_trip(self):
+        text = u'*b* & "x" <\xe9> \u65e5'
+        formatted = format_deck.fast_format.format(text, formats)
+        out = io.BytesIO()
+        format_deck.write_xml(out, 'ascii')(
+            [b'', b'Q', formatted, b'Q', b''])
+        field = out.getvalue()[len(b'<Q>'):-len(b'</Q>')]
+        self.assertEqual(format_deck.unescape(field.decode('ascii')),
+                         formatted)
+
+class CsvRecords(unittest.TestCase):
+
+    def format_csv(self, data):
+        (fd, path) = tempfile.mkstemp(suffix='.csv')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            out = io.BytesIO()
+            source = format_deck.Source(path)
+            records = format_deck.read_csv(source, 'utf-8', None)
+            write = format_deck.write_csv(out, 'utf-8')
+            for record in format_deck.format_records(records, formats,
+                                                     processes=1):
+                write(record)
+            source.close()
+            return out.getvalue()
+        finally:
+            os.remove(path)
+
+    def test_unchanged(self):
+        # Quotes and line endings are kept byte for byte.
+        data = b'a,"b",c\r\n"multi\r\nline",d\r\nlast,"e"'
+        self.assertEqual(self.format_csv(data), data)
+
+    def test_changed(self):
+        self.assertEqual(self.format_csv(b'a,"*b*",c\r\nd,"e"\r\n'),
+                         b'a,<b>b</b>,c\r\nd,"e"\r\n')
+
+class TagModes(unittest.TestCase):
+
+    def format(self, text, tag_mode):
+        records = [([text], [0])]
+        return list(format_deck.format_records(records, formats, tag_mode,
+                                               processes=1))[0][0]
+
+    def test_media(self):
+        # As the 2.x filter: shortcuts may cross tags, but not enter images.
+        self.assertEqual(self.format(u'*a <font size=5>x</font> c*', 'media'),
+                         u'<b>a <font size=5>x</font> c</b>')
+        self.assertEqual(self.format(u'<img src="a_b_c.png">', 'media'),
+                         u'<img src="a_b_c.png">')
+
+    def test_skip(self):
+        self.assertEqual(self.format(u'*a <font size=5>x</font> c*', 'skip'),
+                         u'*a <font size=5>x</font> c*')
+
+    def test_config_db(self):
+        (fd, path) = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        try:
+            con = sqlite3.connect(path)
+            con.execute('create table config (key text, value text)')
+            con.commit()
+            self.assertEqual(format_deck.load_config(path)[1], 'media')
+            con.execute("insert into config values "
+                        "('fast_format_html', 'True')")
+            con.commit()
+            con.close()
+            self.assertEqual(format_deck.load_config(path)[1], 'html')
+        finally:
+            os.remove(path)
+        self.assertEqual(format_deck.load_config(None)[1], 'skip')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,429 @@
+##############################################################################
+#
+# format_deck.py
+#
+# Apply the fast_format shortcuts to the cards of an exported deck, outside
+# Mnemosyne. Neither Mnemosyne nor Qt is needed.
+#
+# Tab-separated (Mnemosyne's text export), comma-separated and xml files
+# (Mnemosyne 1.x exports, or the cards.xml of a .cards file) are read as a
+# stream, or memory-mapped with --mmap, and written back out in the same
+# form: only the formatted fields change. The fields are spread over
+# several processes (see format_many()). Progress is shown on stderr, and
+# the throughput once done.
+#
+#   python tools/format_deck.py deck.tsv -o formatted.tsv
+#   python tools/format_deck.py export.xml -o formatted.xml --mmap -j 4
+#   python tools/format_deck.py deck.csv --columns 2 --config config.db
+#
+# The rules are default_formats, or those of a Mnemosyne configuration:
+# config.db for Mnemosyne 2.x, or config.py for Mnemosyne 1.x. Tags are
+# treated as by the plugin of that version (see --tag-mode): in 1.x no
+# shortcut crosses a tag, while 2.x only skips images and sounds, or
+# formats html fields with fast_format_html.
+#
+##############################################################################
+
+import argparse
+import ast
+import collections
+import csv
+import io
+import mmap
+import os
+import re
+import sqlite3
+import sys
+import time
+
+from xml.sax import saxutils
+
+try:
+    from html import unescape
+except ImportError:
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+import fast_format
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+chunk_bytes = 1024 * 1024
+
+##############################################################################
+# Rules
+
+# How tags are treated, as keyword arguments of format_many(): 'skip' as
+# the 1.x plugin does, 'media' and 'html' as the 2.x filter does without
+# and with fast_format_html, and 'none' formats tags like any other text.
+tag_modes = {
+    'skip'  : {'skip_tags' : True},
+    'media' : {'skip_media' : True},
+    'html'  : {'html' : True},
+    'none'  : {},
+}
+
+def load_config(path):
+    # The rules of a Mnemosyne configuration, or default_formats, and the
+    # tag mode of its plugin.
+    if path is None:
+        return (fast_format.default_formats, 'skip')
+
+    if path.endswith('.py'):
+        # Mnemosyne 1.x: config.py may set fast_format (see the plugin).
+        settings = {}
+        with open(path) as f:
+            exec(compile(f.read(), path, 'exec'), settings)
+        config = settings.get('fast_format', {})
+        formats = list(config.get('formats', []))
+        if config.get('include_default', True) or not formats:
+            formats.extend(fast_format.default_formats)
+        return (formats, 'html' if config.get('html') else 'skip')
+
+    # Mnemosyne 2.x: config.db holds the repr of each setting.
+    con = sqlite3.connect(path)
+    try:
+        rows = dict(con.execute("select key, value from config where key "
+                                "in ('formats', 'fast_format_html')"))
+    finally:
+        con.close()
+    mode = 'media'
+    if ast.literal_eval(rows.get('fast_format_html', 'False')):
+        mode = 'html'
+    if 'formats' not in rows:
+        return (fast_format.default_formats, mode)
+    return ([tuple(f) for f in ast.literal_eval(rows['formats'])], mode)
+
+##############################################################################
+# Readers and writers
+#
+# A reader yields (record, fields) for each part of the file in turn, where
+# record is a list of strings and fields the indexes of those to format. Its
+# writer puts each record back as it was read, with the formatted fields.
+
+class Source(object):
+    # The bytes of the input, read in lines or chunks, with the number
+    # read so far.
+
+    def __init__(self, path, use_mmap=False):
+        self.file = open(path, 'rb') if path != '-' else _stdin()
+        self.map = None
+        try:
+            self.size = os.fstat(self.file.fileno()).st_size
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            self.size = None
+        if use_mmap and self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        self.position = 0
+
+    def lines(self):
+        readline = (self.map or self.file).readline
+        for line in iter(readline, b''):
+            self.position += len(line)
+            yield line
+
+    def chunks(self):
+        read = (self.map or self.file).read
+        for chunk in iter(lambda: read(chunk_bytes), b''):
+            self.position += len(chunk)
+            yield chunk
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+def _stdin():
+    return getattr(sys.stdin, 'buffer', sys.stdin)
+
+def _stdout():
+    return getattr(sys.stdout, 'buffer', sys.stdout)
+
+def _split_ending(line):
+    body = line.rstrip('\r\n')
+    return (body, line[len(body):])
+
+def read_tsv(source, encoding, columns):
+    # One card per line, its fields separated by tabs, without quoting.
+    for line in source.lines():
+        (body, ending) = _split_ending(line.decode(encoding))
+        record = body.split('\t')
+        fields = [i for i in range(len(record))
+                  if columns is None or i in columns]
+        record.append(ending)
+        yield (record, fields)
+
+def write_tsv(out, encoding):
+    def write(record):
+        out.write(('\t'.join(record[:-1]) + record[-1]).encode(encoding))
+    return write
+
+# The csv module of Python 2 only reads and writes bytes.
+csv_bytes = sys.version_info[0] < 3
+
+def read_csv(source, encoding, columns):
+    # Each record is followed by the lines it was read from and a copy of
+    # its fields, so that a record left unchanged is written back as it
+    # was, quotes and line endings included.
+    lines = []
+    def read():
+        for line in source.lines():
+            lines.append(line)
+            yield line if csv_bytes else line.decode(encoding)
+    for record in csv.reader(read()):
+        if csv_bytes:
+            record = [field.decode(encoding) for field in record]
+        fields = [i for i in range(len(record))
+                  if columns is None or i in columns]
+        raw = b''.join(lines)
+        del lines[:]
+        yield (record + [raw, list(record)], fields)
+
+def write_csv(out, encoding):
+    buf = io.BytesIO() if csv_bytes else io.StringIO()
+    def write(record):
+        (raw, original) = record[-2:]
+        if record[:-2] == original:
+            out.write(raw)
+            return
+        ending = _split_ending(raw.decode(encoding))[1]
+        if csv_bytes:
+            csv.writer(buf, lineterminator=ending.encode(encoding)).writerow(
+                [field.encode(encoding) for field in record[:-2]])
+            out.write(buf.getvalue())
+        else:
+            csv.writer(buf, lineterminator=ending).writerow(record[:-2])
+            out.write(buf.getvalue().encode(encoding))
+        buf.seek(0)
+        buf.truncate()
+    return write
+
+def read_xml(source, encoding, tags):
+    # Everything but the text of the given elements is copied as is. Each
+    # record is the bytes before an element, its opening tag, its text,
+    # closing tag and original bytes; only the text is formatted. The
+    # elements must not contain others.
+    alternatives = b'|'.join(re.escape(t.encode(encoding)) for t in tags)
+    field_re = re.compile(b'<(' + alternatives + b')>(.*?)</\\1>', re.DOTALL)
+    open_re = re.compile(b'<(?:' + alternatives + b')>')
+    keep = max(len(t.encode(encoding)) for t in tags) + 1
+
+    if source.map is not None:
+        chunks = [source.map]
+    else:
+        chunks = source.chunks()
+
+    pending = b''
+    for chunk in chunks:
+        data = pending + chunk if pending else chunk
+        last = 0
+        for m in field_re.finditer(data):
+            raw = m.group(2)
+            text = unescape(raw.decode(encoding))
+            record = [data[last:m.start()], m.group(1), text, m.group(1),
+                      raw]
+            last = m.end()
+            if source.map is not None:
+                source.position = last
+            yield (record, [2])
+
+        # Hold back what may be the start of an element cut off by the
+        # end of the chunk.
+        m = open_re.search(data, last)
+        cut = m.start() if m is not None else max(last, len(data) - keep)
+        if cut > last:
+            yield ([data[last:cut]], [])
+        pending = data[cut:]
+    if pending:
+        yield ([pending], [])
+
+def write_xml(out, encoding):
+    def write(record):
+        out.write(record[0])
+        if len(record) == 1:
+            return
+        (tag, text, raw) = (record[1], record[2], record[4])
+        if unescape(raw.decode(encoding)) == text:
+            out.write(b'<' + tag + b'>' + raw + b'</' + tag + b'>')
+        else:
+            out.write(b'<' + tag + b'>'
+                      + escape(text).encode(encoding, 'xmlcharrefreplace')
+                      + b'</' + tag + b'>')
+    return write
+
+def escape(text):
+    # unescape() decodes every entity and character reference; escape()
+    # writes back those that a formatted field needs.
+    return saxutils.escape(text, {'"' : '&quot;'})
+
+readers = {
+    'tsv' : (read_tsv, write_tsv),
+    'csv' : (read_csv, write_csv),
+    'xml' : (read_xml, write_xml),
+}
+
+def guess_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    return {'.csv' : 'csv', '.xml' : 'xml'}.get(ext, 'tsv')
+
+##############################################################################
+# Formatting
+
+class Progress(object):
+    # Counts the fields formatted and reports on stderr at most every
+    # interval seconds.
+
+    interval = 0.5
+
+    def __init__(self, source, quiet=False):
+        self.source = source
+        self.quiet = quiet
+        self.start = clock()
+        self.last = self.start
+        self.records = 0
+        self.fields = 0
+        self.changed = 0
+        self.chars = 0
+
+    def field(self, text, result):
+        self.fields += 1
+        self.chars += len(text)
+        if result != text:
+            self.changed += 1
+
+    def tick(self):
+        now = clock()
+        if not self.quiet and now - self.last >= self.interval:
+            self.last = now
+            self.show(now, '\r')
+
+    def show(self, now, end):
+        elapsed = max(now - self.start, 1e-9)
+        line = '%d fields (%.0f/s, %.2f Mchar/s)' % (
+            self.fields, self.fields / elapsed, self.chars / elapsed / 1e6)
+        if self.source.size:
+            line = '%3.0f%% ' % (100.0 * self.source.position
+                                 / self.source.size) + line
+        sys.stderr.write(line + end)
+        sys.stderr.flush()
+
+    def done(self):
+        now = clock()
+        elapsed = max(now - self.start, 1e-9)
+        if not self.quiet:
+            sys.stderr.write('\r' + ' ' * 60 + '\r')
+        sys.stderr.write('formatted %d fields of %d records (%d changed) in '
+                         '%.2f s: %.0f fields/s, %.2f Mchar/s\n'
+                         % (self.fields, self.records, self.changed, elapsed,
+                            self.fields / elapsed,
+                            self.chars / elapsed / 1e6))
+
+def format_records(records, formats, tag_mode='skip', processes=None,
+                   chunksize=256, progress=None):
+    # Yield each record of records, in order, with its fields formatted.
+    # The fields of every record go to format_many() as one stream, with
+    # tags treated as tag_mode says (see tag_modes).
+    pending = collections.deque()
+
+    def texts():
+        for (record, fields) in records:
+            pending.append((record, collections.deque(fields)))
+            if fields and progress is not None:
+                progress.records += 1
+            for i in fields:
+                yield record[i]
+
+    def ready():
+        while pending and not pending[0][1]:
+            record = pending.popleft()[0]
+            if progress is not None:
+                progress.tick()
+            yield record
+
+    for result in fast_format.format_many(texts(), formats,
+                                          processes=processes,
+                                          chunksize=chunksize,
+                                          **tag_modes[tag_mode]):
+        for record in ready():
+            yield record
+        (record, fields) = pending[0]
+        i = fields.popleft()
+        if progress is not None:
+            progress.field(record[i], result)
+        record[i] = result
+    for record in ready():
+        yield record
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=
+            'Apply the fast_format shortcuts to an exported deck.')
+    parser.add_argument('input', help="tsv, csv or xml file ('-' for stdin)")
+    parser.add_argument('-o', '--output', default='-',
+                        help='output file (default: stdout)')
+    parser.add_argument('--input-format', choices=sorted(readers),
+                        help='format of the input (default: from its name)')
+    parser.add_argument('--config', metavar='FILE',
+                        help='take the rules from a Mnemosyne config.db '
+                             '(2.x) or config.py (1.x)')
+    parser.add_argument('--columns', metavar='N,...',
+                        help='tsv or csv columns to format, from 1 '
+                             '(default: all)')
+    parser.add_argument('--tags', metavar='NAME,...', default='Q,A',
+                        help='xml elements to format (default: %(default)s)')
+    parser.add_argument('--tag-mode', choices=sorted(tag_modes),
+                        help='skip: no shortcut crosses a tag (1.x); '
+                             'media: only images and sounds are skipped '
+                             '(2.x); html: as with fast_format_html (2.x); '
+                             'none: format tags too (default: as the '
+                             'plugin of --config, or skip)')
+    parser.add_argument('--format-tags', dest='tag_mode',
+                        action='store_const', const='none',
+                        help='same as --tag-mode none')
+    parser.add_argument('--encoding', default='utf-8',
+                        help='(default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes (default: one per cpu)')
+    parser.add_argument('--chunksize', type=int, default=256,
+                        help='fields sent to a worker at once '
+                             '(default: %(default)s)')
+    parser.add_argument('--mmap', action='store_true',
+                        help='memory-map the input rather than read it')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='only report the throughput once done')
+    args = parser.parse_args(argv)
+
+    kind = args.input_format or guess_format(args.input)
+    (read, write) = readers[kind]
+    if kind == 'xml':
+        selection = [t.strip() for t in args.tags.split(',') if t.strip()]
+    elif args.columns:
+        selection = set(int(c) - 1 for c in args.columns.split(','))
+    else:
+        selection = None
+
+    (formats, tag_mode) = load_config(args.config)
+    formats = fast_format.compile_formats(formats)
+    source = Source(args.input, args.mmap)
+    out = open(args.output, 'wb') if args.output != '-' else _stdout()
+    progress = Progress(source, args.quiet)
+    try:
+        emit = write(out, args.encoding)
+        records = read(source, args.encoding, selection)
+        for record in format_records(records, formats,
+                                     args.tag_mode or tag_mode, args.jobs,
+                                     args.chunksize, progress):
+            emit(record)
+    finally:
+        if out is not _stdout():
+            out.close()
+        source.close()
+    progress.done()
+
+if __name__ == '__main__':
+    main()